@@ -36,7 +36,7 @@ from dialogs import (XVIPathsDialog,
     AboutDialog, 
     ReportDialog)
 from datastore import get_datastore, set_datastore
-from tools import ScanPathsTask
+from tools import ScanPathsTask, format_total_size, SCAN_QUICK, SCAN_FULL, SCAN_CANDIDATES, SCAN_ESTIMATE
 
 from datetime import datetime, timedelta
 import Queue
@@ -196,9 +196,18 @@ class MainApplication(tk.Frame):
         main_menu.add_command(label='Configure Email Reports', command=self.configure_window_email_reports)
         main_menu.add_separator()
 
-        self.quick_scan = tk.BooleanVar()
-        self.quick_scan.set(False)
-        main_menu.add_checkbutton(label="Enable Quick Scan", onvalue=True, offvalue=False, variable=self.quick_scan)
+        self.scan_mode = tk.StringVar()
+        self.scan_mode.set(SCAN_FULL)
+        main_menu.add_radiobutton(label="Full Scan", value=SCAN_FULL, variable=self.scan_mode)
+        main_menu.add_radiobutton(label="Size Archive/Delete Only", value=SCAN_CANDIDATES, variable=self.scan_mode)
+        main_menu.add_radiobutton(label="Estimate Sizes (sampled)", value=SCAN_ESTIMATE, variable=self.scan_mode)
+        main_menu.add_radiobutton(label="Quick Scan (no sizes)", value=SCAN_QUICK, variable=self.scan_mode)
+        main_menu.add_separator()
+
+        # Ignore the cached OIS results for the next scan
+        self.refresh_ois = tk.BooleanVar()
+        self.refresh_ois.set(False)
+        main_menu.add_checkbutton(label="Force OIS Refresh on Next Scan", onvalue=True, offvalue=False, variable=self.refresh_ois)
 
         main_menu.add_separator()
         main_menu.add_command(label='Export CSV List', command=self.export_list)
@@ -294,8 +303,15 @@ class MainApplication(tk.Frame):
 
         logger.info('Will scan locations now')
 
+        # Results are shown as they arrive, keep the last scan in case this one is cancelled
+        self.previous_directories = self.directories
+        self.directories = []
+        self.update_gui()
+        self.update_list()
+
         self.queue = Queue.Queue()
-        self.scan_task = ScanPathsTask(self.queue, self.quick_scan.get())
+        self.scan_task = ScanPathsTask(self.queue, self.scan_mode.get(), self.refresh_ois.get())
+        self.refresh_ois.set(False)
         self.scan_task.start()
         self.parent.after(100, self.process_queue)
 
@@ -312,10 +328,14 @@ class MainApplication(tk.Frame):
             # If the msg is a list then its returning the list of directories
             if type(msg) == list:
 
-                if len(msg) > 0: # If scan was cancelled, empty list is returned
-                    self.directories = msg # Always get 0 because its a queue so FIFO
+                task_done = True
 
-                    task_done = True
+                if self.scan_task.abort: # If scan was cancelled, keep the last scan's results
+                    self.directories = self.previous_directories
+                    self.update_gui()
+                    self.update_list()
+                else:
+                    self.directories = msg # Always get 0 because its a queue so FIFO
 
                     # Update the GUI and List
                     logger.info('Updating GUI')
@@ -328,6 +348,13 @@ class MainApplication(tk.Frame):
                 # Close the scanning dialog
                 self.scan_dialog.top.destroy()
 
+            elif type(msg) == dict and 'scan_batch' in msg:
+                # A batch of directories found while the scan is still running
+                self.directories.extend(msg['scan_batch'])
+                self.update_gui(log_counts=False)
+                self.insert_list_rows(msg['scan_batch'])
+                self.scan_dialog.str_status.set('Scanning... ' + str(len(self.directories)) + ' directories found')
+
             elif type(msg) == dict:
                 # if it's a dict then its returning an error message to display
                 simpledialog.showwarning(msg['error'],msg['msg'], parent=self)
@@ -337,7 +364,7 @@ class MainApplication(tk.Frame):
 
 
     # Update the various elements of the gui (labels, buttons, etc...)
-    def update_gui(self):
+    def update_gui(self, log_counts=True):
 
         datastore = get_datastore()
 
@@ -346,17 +373,17 @@ class MainApplication(tk.Frame):
         dirs_to_archive = [d for d in self.directories if d['action'] == 'ARCHIVE']
         dirs_to_delete = [d for d in self.directories if d['action'] == 'DELETE']
 
-        logger.info('%d directories to ignore', len(dirs_ignored))
-        logger.info('%d directories to archive', len(dirs_to_archive))
-        logger.info('%d directories to delete', len(dirs_to_delete))
-        logger.info('%d directories to keep', len(dirs_to_keep))
+        if log_counts:
+            logger.info('%d directories to ignore', len(dirs_ignored))
+            logger.info('%d directories to archive', len(dirs_to_archive))
+            logger.info('%d directories to delete', len(dirs_to_delete))
+            logger.info('%d directories to keep', len(dirs_to_keep))
 
         self.str_search_paths.set('Number of XVI Search Paths: ' + str(len(datastore['xvi_paths'])))
         self.str_dirs_scanned.set('Total Directories Scanned: ' + str(len(self.directories)))
         self.str_dirs_ignored.set('Directories Ignored: ' + str(len(dirs_ignored)))
         self.str_dirs_archive.set('Directories to Archive: ' + str(len(dirs_to_archive)))
-        archive_size = "{:.1f}".format(sum(d['dir_size'] for d in dirs_to_archive)/1024.0/1024.0/1024.0)
-        self.str_dirs_archive_size.set('Size: ' + str(archive_size) + "GB")
+        self.str_dirs_archive_size.set('Size: ' + format_total_size(dirs_to_archive))
 
         if 'archive_path' in datastore:
             ap = datastore['archive_path']
@@ -364,8 +391,7 @@ class MainApplication(tk.Frame):
             self.str_archive_path.set('Archive Path: ' + ap)
 
         self.str_dirs_delete.set('Directories to Delete: ' + str(len(dirs_to_delete)))
-        delete_size = "{:.1f}".format(sum(d['dir_size'] for d in dirs_to_delete)/1024.0/1024.0/1024.0)
-        self.str_dirs_delete_size.set('Size: ' + str(delete_size) + "GB")
+        self.str_dirs_delete_size.set('Size: ' + format_total_size(dirs_to_delete))
 
         # Set the button states
         if(len(dirs_to_archive) > 0):
@@ -383,16 +409,26 @@ class MainApplication(tk.Frame):
 
         self.treeview_patients.delete(*self.treeview_patients.get_children())
 
+        self.insert_list_rows(self.directories)
+
+    # Add rows for the directories to the end of the list, if not filtered out
+    def insert_list_rows(self, directories):
+
         show_actions = [a['action'] for a in self.actions_filter if a['show']]
 
-        for p in self.directories:
+        for p in directories:
             if not p['action'] in show_actions:
                 continue
 
+            # Estimated sizes are marked with a ~
+            size = "{:.1f}".format(p['dir_size']/1024.0/1024.0/1024.0)
+            if p['size_estimated']:
+                size = '~' + size
+
             if p['action'] == 'IGNORE':
-                self.treeview_patients.insert("", 'end', text="", values=(p['action'],'','','','','','',p['dir_name'],p['path'],"{:.1f}".format(p['dir_size']/1024.0/1024.0/1024.0)))
+                self.treeview_patients.insert("", 'end', text="", values=(p['action'],'','','','','','',p['dir_name'],p['path'],size))
             else:
-                self.treeview_patients.insert("", 'end', text="", values=(p['action'],p['mrn'],p['name'],p['finished_treatment'],p['clinical_trial'],p['has_4d'],p['last_fraction_date'],p['dir_name'],p['path'],"{:.1f}".format(p['dir_size']/1024.0/1024.0/1024.0)))
+                self.treeview_patients.insert("", 'end', text="", values=(p['action'],p['mrn'],p['name'],p['finished_treatment'],p['clinical_trial'],p['has_4d'],p['last_fraction_date'],p['dir_name'],p['path'],size))
 
     # Callback for headers of treeview columns to perform sort on that column
     def sortby(self, tree, col, descending):
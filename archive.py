@@ -0,0 +1,415 @@
+# Copyright 2022 University of New South Wales, Ingham Institute
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os, errno, hashlib, json, shutil, threading
+
+from workers import thread_map
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Kernel side file copying, which avoids copying the data through Python. These are only
+# available from Python 3 (copy_file_range from 3.8, on Linux), set to None to disable.
+copy_file_range = getattr(os, 'copy_file_range', None)
+sendfile = getattr(os, 'sendfile', None)
+
+# Size of the buffer used to copy files when kernel side copying isn't available. This is
+# much larger than the 16KB shutil.copyfile uses in Python 2.7 so that fewer, larger
+# reads and writes are made, which matters most on network shares.
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# Each copy worker thread reuses its own buffer
+copy_buffers = threading.local()
+
+# Errors meaning a kernel side copy isn't supported between these files, in which case
+# the data is copied through a buffer instead
+KERNEL_COPY_UNSUPPORTED = set([errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EBADF,
+    getattr(errno, 'EOPNOTSUPP', errno.EINVAL), getattr(errno, 'ENOTSUP', errno.EINVAL)])
+
+# Set the size of the file being written in advance, so the file system can allocate it in
+# one go rather than growing it with each write
+def preallocate(f, size):
+
+    if size == 0:
+        return
+
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return
+        except OSError:
+            # Not supported by all file systems, e.g. some network shares
+            pass
+
+    f.truncate(size)
+
+# Copy the data from fsrc to fdst in the kernel, returning the number of bytes copied or
+# None if neither copy_file_range nor sendfile can be used for these files
+def copy_data_kernel(fsrc, fdst, size):
+
+    in_fd = fsrc.fileno()
+    out_fd = fdst.fileno()
+
+    for kernel_copy in [copy_file_range, sendfile]:
+
+        if kernel_copy is None:
+            continue
+
+        copied = 0
+        try:
+            while True:
+                if kernel_copy is copy_file_range:
+                    n = copy_file_range(in_fd, out_fd, max(size - copied, COPY_BUFFER_SIZE), copied, copied)
+                else:
+                    n = sendfile(out_fd, in_fd, copied, max(size - copied, COPY_BUFFER_SIZE))
+
+                if n == 0:
+                    return copied
+                copied += n
+
+        except OSError as e:
+            # Try the next way of copying, unless the copy had already started
+            if copied > 0 or not e.errno in KERNEL_COPY_UNSUPPORTED:
+                raise
+
+    return None
+
+# Return the copy buffer for this thread
+def get_copy_buffer():
+
+    buf = getattr(copy_buffers, 'buf', None)
+    if buf is None:
+        buf = copy_buffers.buf = bytearray(COPY_BUFFER_SIZE)
+
+    return buf
+
+# Copy the data from fsrc to fdst through a large buffer, reused by each thread, returning
+# the number of bytes copied. If checksum (a hashlib object) is given, it is updated with
+# the data as it is copied.
+def copy_data_buffered(fsrc, fdst, checksum=None):
+
+    buf = get_copy_buffer()
+    view = memoryview(buf)
+
+    copied = 0
+    while True:
+        n = fsrc.readinto(buf)
+        if not n:
+            return copied
+
+        fdst.write(view[:n])
+        if checksum:
+            checksum.update(view[:n])
+        copied += n
+
+# Copy a file along with its metadata, in place of shutil.copy2. The destination is
+# preallocated, and the data is copied in the kernel where possible, otherwise through a
+# large buffer. If hash_name (e.g. 'md5') is given, the data is copied through the buffer
+# so the checksum of the file can be computed as it is read, and its hex digest returned.
+def copy_file(src, dst, hash_name=None):
+
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+
+    checksum = hashlib.new(hash_name) if hash_name else None
+
+    with open(src, 'rb') as fsrc:
+        size = os.fstat(fsrc.fileno()).st_size
+
+        with open(dst, 'wb') as fdst:
+            preallocate(fdst, size)
+
+            copied = None
+            if not checksum:
+                copied = copy_data_kernel(fsrc, fdst, size)
+            if copied is None:
+                copied = copy_data_buffered(fsrc, fdst, checksum)
+
+            # The file may have changed size since it was opened
+            if not copied == size:
+                fdst.truncate(copied)
+
+    shutil.copystat(src, dst)
+
+    if checksum:
+        return checksum.hexdigest()
+
+# Return the hex digest of the file's data using hash_name, and the size of the data
+def hash_file(path, hash_name):
+
+    buf = get_copy_buffer()
+    view = memoryview(buf)
+    checksum = hashlib.new(hash_name)
+    size = 0
+
+    with open(path, 'rb') as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                return checksum.hexdigest(), size
+
+            checksum.update(view[:n])
+            size += n
+
+# Return the relative paths of the directories in a manifest, parents before children
+def manifest_dirs(manifest):
+    return sorted(manifest['dir_mtimes'], key=lambda d: (d.count(os.sep), d))
+
+# Return the relative paths of the directories (parents before children) and files in
+# the tree at src, along with the modification time of each directory (see
+# catalog.directory_unchanged). As with shutil.copytree, links are followed, and an
+# error is raised if any directory can't be listed, rather than leaving it out.
+def list_tree(src):
+
+    rel_dirs = [os.curdir]
+    rel_files = []
+    dir_mtimes = {}
+
+    def raise_error(e):
+        raise e
+
+    for dir_path, dir_names, file_names in os.walk(src, onerror=raise_error, followlinks=True):
+
+        rel_path = os.path.relpath(dir_path, src)
+        dir_mtimes[rel_path] = os.path.getmtime(dir_path)
+
+        for dir_name in dir_names:
+            rel_dirs.append(os.path.normpath(os.path.join(rel_path, dir_name)))
+
+        for file_name in file_names:
+            rel_files.append(os.path.normpath(os.path.join(rel_path, file_name)))
+
+    return rel_dirs, rel_files, dir_mtimes
+
+# Record of the files copied to an archived directory, kept in journal_file next to it
+# until the copy has been verified. If the copy is interrupted (by a reboot, shutdown or
+# network error) the journal is left behind, and the copy is resumed when the directory
+# is archived again: only the files not recorded as finished, or which have changed
+# since, are copied. Each finished file is appended as a line of JSON, so at worst the
+# last file is lost and copied again. The journal also records the src directory, and a
+# copy from any other directory (e.g. one with the same name in another XVI location)
+# isn't resumed from it.
+class CopyJournal:
+
+    def __init__(self, journal_file, src):
+
+        self.journal_file = journal_file
+        self.src = os.path.abspath(src)
+        self.lock = threading.Lock()
+        self.entries = {}
+
+        # An existing journal means a previous copy was interrupted
+        self.resumed = os.path.exists(journal_file)
+
+        if self.resumed:
+            journal_src = None
+
+            with open(journal_file, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Partly written when the copy was interrupted
+                        continue
+
+                    if not 'path' in entry:
+                        journal_src = entry.get('src')
+                    elif entry.get('checksum'):
+                        self.entries[entry['path']] = entry
+                    else:
+                        self.entries.pop(entry['path'], None)
+
+            if not journal_src == self.src:
+                raise IOError(journal_file + ' is for a copy from ' + str(journal_src) + ', not ' + self.src)
+
+            logger.info('Resuming copy with %d files finished from %s', len(self.entries), journal_file)
+
+        self.file = None
+
+    # Open the journal to record files in, before the destination directory is created so
+    # that an interrupted copy always leaves a journal behind
+    def start(self):
+        self.file = open(self.journal_file, 'a')
+
+        if not self.resumed:
+            self.file.write(json.dumps({'src': self.src}) + '\n')
+            self.file.flush()
+
+    # Return the journal entry for a file if it finished copying and the src file hasn't
+    # changed since, otherwise None
+    def finished(self, rel_path, src_stat, hash_name):
+
+        entry = self.entries.get(rel_path)
+        if entry and entry['size'] == src_stat.st_size and entry['mtime'] == src_stat.st_mtime and entry['hash'] == hash_name:
+            return entry
+
+    # Record that a file finished copying, along with its checksum if computed
+    def record(self, rel_path, src_stat, hash_name, checksum):
+
+        entry = {'path': rel_path, 'size': src_stat.st_size, 'mtime': src_stat.st_mtime,
+            'hash': hash_name, 'checksum': checksum or True}
+
+        with self.lock:
+            self.entries[rel_path] = entry
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+
+    # Forget that the files failed verification, so they are copied again next time. This
+    # can be called once the journal is closed.
+    def forget(self, rel_paths):
+
+        with self.lock:
+            with open(self.journal_file, 'a') as f:
+                for rel_path in rel_paths:
+                    self.entries.pop(rel_path, None)
+                    f.write(json.dumps({'path': rel_path, 'checksum': None}) + '\n')
+
+    def close(self):
+
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+
+    # Remove the journal once the copy has been verified
+    def remove(self):
+
+        self.close()
+        os.remove(self.journal_file)
+
+# Copy the files at the relative paths rel_files from src to dst, creating the
+# directories rel_dirs (parents before children) first. The files are copied by a pool
+# of num_workers threads, since when copying many small files to a network share most of
+# the time is spent waiting on each file to be opened and closed. As with
+# shutil.copytree, dst must not already exist and the file and directory metadata is
+# copied along with the data. If any file can't be copied no more are started and the
+# exception is raised once the files being copied are finished. If hash_name is given a
+# dict of the checksum of each file, keyed by relative path, is returned.
+#
+# If a journal (see CopyJournal) is given, each file is recorded in it once copied. If
+# the journal is from an interrupted copy dst may already exist, and the files recorded
+# in it are not copied again.
+def copy_files(src, dst, rel_dirs, rel_files, num_workers, hash_name=None, journal=None):
+
+    resumed = journal and journal.resumed
+
+    # An existing dst without a journal isn't resumed, since it wasn't copied here
+    if journal:
+        if not resumed and os.path.exists(dst):
+            raise OSError(errno.EEXIST, os.strerror(errno.EEXIST), dst)
+        journal.start()
+
+    if not (resumed and os.path.isdir(dst)):
+        os.makedirs(dst)
+
+    for rel_dir in rel_dirs:
+        dst_dir = os.path.join(dst, rel_dir)
+        if not rel_dir == os.curdir and not (resumed and os.path.isdir(dst_dir)):
+            os.mkdir(dst_dir)
+
+    failed = []
+
+    def copy_rel_file(rel_path):
+        try:
+            src_file = os.path.join(src, rel_path)
+            dst_file = os.path.join(dst, rel_path)
+
+            if not journal:
+                return copy_file(src_file, dst_file, hash_name)
+
+            src_stat = os.stat(src_file)
+            entry = journal.finished(rel_path, src_stat, hash_name)
+            if entry and os.path.isfile(dst_file) and os.path.getsize(dst_file) == entry['size']:
+                return entry['checksum']
+
+            checksum = copy_file(src_file, dst_file, hash_name)
+            journal.record(rel_path, src_stat, hash_name, checksum)
+            return checksum
+        except Exception:
+            failed.append(rel_path)
+            raise
+
+    checksums = thread_map(copy_rel_file, rel_files, num_workers, lambda: len(failed) > 0)
+
+    # Copying files into a directory changes its mtime, so do the directories last
+    for rel_dir in reversed(rel_dirs):
+        shutil.copystat(os.path.join(src, rel_dir), os.path.join(dst, rel_dir))
+
+    if hash_name:
+        return dict(zip(rel_files, checksums))
+
+# Copy a patient directory in place of shutil.copytree, see copy_files. Returns the
+# checksums of the files (if hash_name is given) and the modification times of the src
+# directories before they were copied, to check that nothing changed while copying.
+def copy_tree(src, dst, num_workers, hash_name=None, journal=None):
+
+    rel_dirs, rel_files, dir_mtimes = list_tree(src)
+    return copy_files(src, dst, rel_dirs, rel_files, num_workers, hash_name, journal), dir_mtimes
+
+# Copy a patient directory using the manifest recorded when it was scanned (see
+# ScanCatalog.get_manifest), instead of walking the source directory again. Returns the
+# checksums of the files if hash_name is given.
+def copy_from_manifest(src, dst, manifest, num_workers, hash_name=None, journal=None):
+
+    return copy_files(src, dst, manifest_dirs(manifest), [f[0] for f in manifest['files']], num_workers, hash_name, journal)
+
+# Check the checksums of the files copied to dst by reading each of them once, using a
+# pool of num_workers threads. Returns a dict describing the problem with each file
+# which doesn't match, keyed by relative path, which is empty if every file matches,
+# along with the total size of the files read.
+def verify_checksums(dst, checksums, hash_name, num_workers):
+
+    def verify_file(rel_path):
+        try:
+            dst_checksum, size = hash_file(os.path.join(dst, rel_path), hash_name)
+        except (IOError, OSError):
+            return rel_path + ' is missing', 0
+
+        if not dst_checksum == checksums[rel_path]:
+            return rel_path + ' has ' + hash_name + ' ' + dst_checksum + ', expected ' + checksums[rel_path], size
+
+        return None, size
+
+    rel_paths = sorted(checksums)
+    results = thread_map(verify_file, rel_paths, num_workers)
+
+    problems = dict((p, r[0]) for p, r in zip(rel_paths, results) if r[0])
+    return problems, sum(r[1] for r in results)
+
+# Save the checksums of the files in an archived directory to checksums_file, in the
+# format read by md5sum -c (or sha1sum etc.)
+def write_checksums(checksums_file, checksums):
+
+    with open(checksums_file, 'w') as f:
+        for rel_path in sorted(checksums):
+            f.write(checksums[rel_path] + '  ' + rel_path.replace(os.sep, '/') + '\n')
+
+# Check that each file in the manifest exists in dst with the size recorded in the
+# manifest. Returns a list describing each problem found, which is empty if the copy
+# is complete.
+def verify_against_manifest(dst, manifest):
+
+    problems = []
+
+    for rel_path, size, mtime in manifest['files']:
+        try:
+            dst_size = os.stat(os.path.join(dst, rel_path)).st_size
+        except OSError:
+            problems.append(rel_path + ' is missing')
+            continue
+
+        if not dst_size == size:
+            problems.append(rel_path + ' is ' + str(dst_size) + ' bytes, expected ' + str(size))
+
+    return problems
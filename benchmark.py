@@ -0,0 +1,475 @@
+#!/usr/bin/python
+
+# Copyright 2022 University of New South Wales, Ingham Institute
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Benchmarks for the XVI Archive Tool which can be run without an XVI system. A
+# synthetic tree of XVI patient directories is generated and then scanned, e.g.:
+#
+#   python benchmark.py scan --patients 500 --workers 1,4,8
+#
+# The classification of patients from the OIS query results can be timed with synthetic
+# results, e.g.:
+#
+#   python benchmark.py classify --patients 3000 --rows 50000
+#
+# The OIS queries and classification can be load tested against a synthetic OIS in a
+# SQLite database, e.g.:
+#
+#   python benchmark.py ois --patients 100000
+#
+# Copying patient directories to the archive can be timed with a generated tree, by
+# default on local disk or to a mounted network share given by --dest, e.g.:
+#
+#   python benchmark.py copy --patients 20 --dest /mnt/archive --workers 1,4,8
+
+import os, copy, random, shutil, tempfile, timeit, logging, Queue, yaml
+from datetime import datetime, timedelta
+
+from optparse import OptionParser
+
+import tools, archive
+from tools import ScanPathsTask, format_total_size, index_ois_results, SCAN_QUICK, SCAN_FULL, SCAN_ESTIMATE
+from datastore import get_datastore
+from synthetic_ois import create_synthetic_ois
+
+logger = logging.getLogger(__name__)
+
+# Generate a tree of synthetic XVI patient directories in root. Each patient has a number
+# of scans, each with a set of projection (.his) files and a reconstruction. File sizes
+# follow a log-normal distribution around file_size (bytes). Extra levels of nesting can
+# be added below each scan directory. Returns the total number of files and bytes written.
+def generate_xvi_tree(root, num_patients, scans_per_patient, projections_per_scan,
+        file_size, size_spread=0.5, nesting=0, other_dirs=2, seed=0):
+
+    rnd = random.Random(seed)
+    data = os.urandom(1024 * 1024)
+
+    def write_file(path, size):
+        with open(path, 'wb') as f:
+            while size > 0:
+                f.write(data[:min(size, len(data))])
+                size -= len(data)
+
+    total_files = 0
+    total_bytes = 0
+
+    mrns = set()
+    while len(mrns) < num_patients:
+        mrns.add(rnd.randint(1000000, 9999999))
+
+    for mrn in sorted(mrns):
+
+        for s in range(rnd.randint(1, 2 * scans_per_patient - 1)):
+
+            scan_dir = os.path.join(root, 'patient_' + str(mrn), 'IMAGES', 'img_1.3.46.423632.%d.%d' % (mrn, s))
+            for n in range(nesting):
+                scan_dir = os.path.join(scan_dir, 'level_' + str(n))
+            os.makedirs(os.path.join(scan_dir, 'Reconstruction'))
+
+            for p in range(projections_per_scan):
+                size = int(rnd.lognormvariate(0, size_spread) * file_size)
+                write_file(os.path.join(scan_dir, '%05d.his' % p), size)
+                total_files += 1
+                total_bytes += size
+
+            size = int(rnd.lognormvariate(0, size_spread) * file_size * 10)
+            write_file(os.path.join(scan_dir, 'Reconstruction', 'recon.SCAN'), size)
+            total_files += 1
+            total_bytes += size
+
+    # Directories which aren't patient directories and will be ignored
+    for o in range(other_dirs):
+        os.makedirs(os.path.join(root, 'other_' + str(o)))
+
+    return total_files, total_bytes
+
+# Run a ScanPathsTask to completion and return the list of directories and the time taken
+def time_scan(scan_mode):
+
+    queue = Queue.Queue()
+    start_time = timeit.default_timer()
+
+    scan_task = ScanPathsTask(queue, scan_mode)
+    scan_task.start()
+    scan_task.join()
+
+    duration = timeit.default_timer() - start_time
+
+    directories = []
+    while not queue.empty():
+        msg = queue.get(0)
+        if type(msg) == list:
+            directories = msg
+
+    return directories, duration
+
+# Write the settings used by the scan into the current (benchmark) directory
+def write_settings(xvi_path, workers, catalog):
+
+    with open('settings.yaml', 'w') as f:
+        yaml.dump({'xvi_paths': [xvi_path], 'scan_workers': workers, 'scan_catalog': catalog}, f)
+
+def report(name, directories, duration, total_files, total_bytes):
+
+    print('%-30s %8.2fs %10.1f dirs/s %12.1f files/s %10.1f MB/s' % (name, duration,
+        len(directories) / duration, total_files / duration, total_bytes / duration / 1024.0 / 1024.0))
+
+# Time the scan in quick and estimate modes, and in full mode with each of the numbers
+# of workers, with and without the scan catalog
+def benchmark_scan(options):
+
+    work_dir = tempfile.mkdtemp(prefix='xvi_benchmark_')
+    xvi_path = options.path or os.path.join(work_dir, 'xvi')
+
+    try:
+        if not options.path:
+            print('Generating %d patients in %s' % (options.patients, xvi_path))
+            total_files, total_bytes = generate_xvi_tree(xvi_path, options.patients, options.scans,
+                options.projections, options.file_size * 1024, options.size_spread, options.nesting,
+                seed=options.seed)
+        else:
+            info = tools.get_size_info(xvi_path)
+            total_files, total_bytes = info['file_count'], info['size']
+
+        print('%d files, %.1f MB' % (total_files, total_bytes / 1024.0 / 1024.0))
+
+        if options.no_scandir:
+            tools.scandir = None
+
+        # Settings and the catalog are read from the current directory
+        os.chdir(work_dir)
+
+        workers = [int(w) for w in options.workers.split(',')]
+
+        write_settings(xvi_path, workers[0], False)
+        directories, duration = time_scan(SCAN_QUICK)
+        report('quick', directories, duration, 0, 0)
+
+        directories, duration = time_scan(SCAN_ESTIMATE)
+        report('estimate, %d workers' % workers[0], directories, duration, total_files, total_bytes)
+        print('%-30s %s, actual %.1fGB' % ('', format_total_size(directories), total_bytes / 1024.0 / 1024.0 / 1024.0))
+
+        for w in workers:
+            write_settings(xvi_path, w, False)
+            directories, duration = time_scan(SCAN_FULL)
+            report('full, %d workers' % w, directories, duration, total_files, total_bytes)
+
+        for w in workers:
+            if os.path.exists('catalog.db'):
+                os.remove('catalog.db')
+            write_settings(xvi_path, w, True)
+            directories, duration = time_scan(SCAN_FULL)
+            report('catalog cold, %d workers' % w, directories, duration, total_files, total_bytes)
+            directories, duration = time_scan(SCAN_FULL)
+            report('catalog warm, %d workers' % w, directories, duration, total_files, total_bytes)
+
+    finally:
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+        if options.keep:
+            print('Benchmark files kept in ' + work_dir)
+        else:
+            shutil.rmtree(work_dir)
+
+# Copy each patient directory in src to dst with copy_func(src, dst), returning the time taken
+def time_copy(src, dst, copy_func):
+
+    start_time = timeit.default_timer()
+
+    for dir_name in os.listdir(src):
+        copy_func(os.path.join(src, dir_name), os.path.join(dst, dir_name))
+
+    duration = timeit.default_timer() - start_time
+
+    shutil.rmtree(dst)
+
+    return duration
+
+# Time copying a generated tree of patient directories with shutil.copytree as the archive
+# used to, and with the copy engine in archive.py using each of the numbers of workers,
+# with and without kernel side copying. The copy and verification is also timed, comparing
+# the size check the archive used to do with streaming checksums.
+def benchmark_copy(options):
+
+    work_dir = tempfile.mkdtemp(prefix='xvi_benchmark_')
+    src = os.path.join(work_dir, 'xvi')
+    dst_root = options.dest or work_dir
+
+    try:
+        print('Generating %d patients in %s' % (options.patients, src))
+        total_files, total_bytes = generate_xvi_tree(src, options.patients, options.scans,
+            options.projections, options.file_size * 1024, options.size_spread, options.nesting,
+            other_dirs=0, seed=options.seed)
+        print('%d files, %.1f MB, copying to %s' % (total_files, total_bytes / 1024.0 / 1024.0, dst_root))
+
+        dst = os.path.join(dst_root, 'xvi_benchmark_copy')
+
+        def report_copy(name, duration):
+            print('%-30s %8.2fs %12.1f files/s %10.1f MB/s' % (name, duration,
+                total_files / duration, total_bytes / duration / 1024.0 / 1024.0))
+
+        report_copy('shutil.copytree', time_copy(src, dst, shutil.copytree))
+
+        def copy_check_size(s, d):
+            shutil.copytree(s, d)
+            tools.get_size_info(s)
+            tools.get_size_info(d)
+
+        report_copy('copytree + size check', time_copy(src, dst, copy_check_size))
+
+        kernel_copy = (archive.copy_file_range, archive.sendfile)
+
+        for w in [int(w) for w in options.workers.split(',')]:
+
+            archive.copy_file_range, archive.sendfile = None, None
+            report_copy('buffered, %d workers' % w, time_copy(src, dst, lambda s, d: archive.copy_tree(s, d, w)))
+
+            if any(kernel_copy):
+                archive.copy_file_range, archive.sendfile = kernel_copy
+                report_copy('kernel, %d workers' % w, time_copy(src, dst, lambda s, d: archive.copy_tree(s, d, w)))
+
+            def copy_check_md5(s, d):
+                checksums, dir_mtimes = archive.copy_tree(s, d, w, 'md5')
+                problems, size = archive.verify_checksums(d, checksums, 'md5', w)
+
+            report_copy('md5 + verify, %d workers' % w, time_copy(src, dst, copy_check_md5))
+
+        archive.copy_file_range, archive.sendfile = kernel_copy
+
+    finally:
+        if options.keep:
+            print('Benchmark files kept in ' + work_dir)
+        else:
+            shutil.rmtree(work_dir)
+
+# Return the patient directories, as found by a scan, for the MRNs
+def patient_directories(mrns, path=''):
+
+    directories = []
+    for mrn in mrns:
+        directories.append({'path': path, 'dir_name': 'patient_' + mrn, 'action': 'KEEP', 'mrn': mrn, 'name': '',
+            'finished_treatment': False, 'clinical_trial': False, 'has_4d': False, 'last_fraction_date': ''})
+
+    return directories
+
+# Generate synthetic patient directories and the results of the three OIS queries for
+# them. Returns the directories and a (finished_treatment, clinical_trials, has_4d) tuple
+# as returned by the queries.
+def generate_ois_results(num_patients, num_rows, seed=0):
+
+    rnd = random.Random(seed)
+    now = datetime.now()
+
+    mrns = [str(mrn) for mrn in rnd.sample(range(1000000, 9999999), num_patients)]
+
+    directories = patient_directories(mrns)
+
+    def row(mrn):
+        return {'IDA': mrn, 'Last_Name': 'Last' + mrn, 'First_Name': 'First', 'MIddle_Name': ''}
+
+    # Most patients have several treatment fields, some haven't been treated yet
+    finished_treatment = []
+    for r in range(num_rows):
+        ft = row(rnd.choice(mrns[:int(num_patients * 0.9)]))
+        presc = rnd.randint(1, 30)
+        ft['presc_fractions'] = presc
+        ft['deliv_fractions'] = presc if rnd.random() < 0.9 else rnd.randint(0, presc)
+        ft['last_fraction_date'] = now - timedelta(days=rnd.randint(0, 1000))
+        finished_treatment.append(ft)
+
+    clinical_trials = [row(mrn) for mrn in rnd.sample(mrns, num_patients // 20)]
+    has_4d = [row(mrn) for mrn in rnd.sample(mrns, num_patients // 10)]
+
+    return directories, (finished_treatment, clinical_trials, has_4d)
+
+# The classification as it was before the OIS results were indexed by MRN, where the
+# results are searched for each patient's rows, for comparison
+def classify_unindexed(directories, ois_results):
+
+    finished_treatment, clinical_trials, has_4d = ois_results
+
+    for p in directories:
+
+        patient_finished_treatment = [ft for ft in finished_treatment if ft['IDA'] == p['mrn']]
+
+        if len(patient_finished_treatment) > 0:
+            p['finished_treatment'] = True
+
+        for ft in patient_finished_treatment:
+            p['name'] = ft['Last_Name'] + ' ' + ft['First_Name'] + ' ' + ft['MIddle_Name']
+            if type(p['last_fraction_date']) == datetime:
+                if ft['last_fraction_date'] > p['last_fraction_date']:
+                    p['last_fraction_date'] = ft['last_fraction_date']
+            else:
+                p['last_fraction_date'] = ft['last_fraction_date']
+            if not ft['presc_fractions'] == ft['deliv_fractions']:
+                p['finished_treatment'] = False
+
+        if type(p['last_fraction_date']) == datetime:
+            if datetime.now()-timedelta(days=14) <= p['last_fraction_date']:
+                p['finished_treatment'] = False
+
+        patient_clinical_trials = [ct for ct in clinical_trials if ct['IDA'] == p['mrn']]
+        if len(patient_clinical_trials) > 0:
+            p['clinical_trial'] = True
+            p['name'] = patient_clinical_trials[0]['Last_Name'] + ' ' + patient_clinical_trials[0]['First_Name'] + ' ' + patient_clinical_trials[0]['MIddle_Name']
+
+        patient_has_4d = [h4 for h4 in has_4d if h4['IDA'] == p['mrn']]
+        if len(patient_has_4d) > 0:
+            p['has_4d'] = True
+            p['name'] = patient_has_4d[0]['Last_Name'] + ' ' + patient_has_4d[0]['First_Name'] + ' ' + patient_has_4d[0]['MIddle_Name']
+
+        if p['finished_treatment']:
+            if p['clinical_trial'] or p['has_4d']:
+                p['action'] = 'ARCHIVE'
+            else:
+                p['action'] = 'DELETE'
+
+# Time the classification of patients from synthetic OIS results, with the results
+# indexed by MRN and by searching them for each patient
+def benchmark_classify(options):
+
+    print('Generating OIS results for %d patients, %d treatment fields' % (options.patients, options.rows))
+    directories, ois_results = generate_ois_results(options.patients, options.rows, options.seed)
+
+    scan_task = ScanPathsTask(Queue.Queue(), SCAN_QUICK)
+    scan_task.directories = copy.deepcopy(directories)
+
+    start_time = timeit.default_timer()
+    scan_task.ois_index = index_ois_results(*ois_results)
+    scan_task.fetch_patient_info()
+    indexed_duration = timeit.default_timer() - start_time
+
+    unindexed_directories = copy.deepcopy(directories)
+
+    start_time = timeit.default_timer()
+    classify_unindexed(unindexed_directories, ois_results)
+    unindexed_duration = timeit.default_timer() - start_time
+
+    print('%-30s %8.3fs' % ('indexed', indexed_duration))
+    print('%-30s %8.3fs' % ('unindexed', unindexed_duration))
+    print('%-30s %8.1fx' % ('speed-up', unindexed_duration / indexed_duration))
+
+    if not scan_task.directories == unindexed_directories:
+        print('Classifications differ!')
+
+# Query OIS for the patients with directories in path and classify them as a scan does,
+# returning the time taken to query and to classify
+def time_ois(mrns, path):
+
+    scan_task = ScanPathsTask(Queue.Queue(), SCAN_QUICK)
+    scan_task.datastore = get_datastore()
+    scan_task.directories = patient_directories(mrns, path)
+
+    start_time = timeit.default_timer()
+    scan_task.query_patient_info()
+    query_duration = timeit.default_timer() - start_time
+
+    start_time = timeit.default_timer()
+    scan_task.fetch_patient_info()
+    classify_duration = timeit.default_timer() - start_time
+
+    actions = {}
+    for p in scan_task.directories:
+        actions[p['action']] = actions.get(p['action'], 0) + 1
+
+    return query_duration, classify_duration, actions
+
+# Time querying a synthetic OIS in a SQLite database and classifying the patients, with
+# and without the OIS cache. The next night is simulated by expiring the cached results
+# of patients who aren't settled, so only they are checked again.
+def benchmark_ois(options):
+
+    work_dir = tempfile.mkdtemp(prefix='xvi_benchmark_')
+
+    try:
+        # Settings, the OIS cache and the synthetic OIS are all in the benchmark directory
+        os.chdir(work_dir)
+
+        print('Generating synthetic OIS with %d patients' % options.patients)
+        start_time = timeit.default_timer()
+        mrns = create_synthetic_ois('ois.db', options.patients, seed=options.seed)
+        print('%-30s %8.2fs' % ('generated', timeit.default_timer() - start_time))
+
+        # Empty patient directories, since whether they have been modified is checked
+        for mrn in mrns:
+            os.makedirs(os.path.join('xvi', 'patient_' + mrn))
+
+        runs = [('no cache', False, 12), ('cache cold', True, 12), ('cache warm', True, 12),
+            ('cache next night', True, 0)]
+
+        for name, cache, active_hours in runs:
+
+            with open('settings.yaml', 'w') as f:
+                yaml.dump({'ois_config': {'backend': 'sqlite', 'db': 'ois.db'}, 'ois_cache': cache,
+                    'ois_cache_active_hours': active_hours, 'ois_mrn_batch_size': options.batch_size}, f)
+
+            query_duration, classify_duration, actions = time_ois(mrns, 'xvi')
+            print('%-30s %8.2fs query %8.2fs classify %8.1f MRNs/s  %s' % (name, query_duration,
+                classify_duration, len(mrns) / (query_duration + classify_duration), actions))
+
+    finally:
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+        if options.keep:
+            print('Benchmark files kept in ' + work_dir)
+        else:
+            shutil.rmtree(work_dir)
+
+if __name__ == "__main__":
+
+    usage = "usage: %prog scan|classify|ois|copy [options]"
+    parser = OptionParser(usage)
+    parser.add_option('--path', dest='path', default=None,
+                      help='scan an existing tree instead of generating one')
+    parser.add_option('--dest', dest='dest', default=None,
+                      help='directory to copy to, e.g. on a network share')
+    parser.add_option('--patients', dest='patients', type='int', default=200)
+    parser.add_option('--rows', dest='rows', type='int', default=50000,
+                      help='number of treatment field rows when classifying')
+    parser.add_option('--batch-size', dest='batch_size', type='int', default=500,
+                      help='number of MRNs in each OIS query')
+    parser.add_option('--scans', dest='scans', type='int', default=3,
+                      help='average number of scans per patient')
+    parser.add_option('--projections', dest='projections', type='int', default=50,
+                      help='number of projection files per scan')
+    parser.add_option('--file-size', dest='file_size', type='int', default=16,
+                      help='median projection file size in KB')
+    parser.add_option('--size-spread', dest='size_spread', type='float', default=0.5,
+                      help='sigma of the log-normal file size distribution')
+    parser.add_option('--nesting', dest='nesting', type='int', default=0,
+                      help='extra directory levels below each scan')
+    parser.add_option('--workers', dest='workers', default='1,4',
+                      help='comma separated numbers of scan workers to compare')
+    parser.add_option('--no-scandir', dest='no_scandir', default=False, action='store_true',
+                      help='size directories without scandir')
+    parser.add_option('--seed', dest='seed', type='int', default=0)
+    parser.add_option('--keep', dest='keep', default=False, action='store_true',
+                      help='keep the generated files')
+    options, remainder = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    # OIS isn't configured when benchmarking, so don't report the missing queries
+    logging.getLogger('database').disabled = True
+
+    if remainder == ['scan']:
+        benchmark_scan(options)
+    elif remainder == ['classify']:
+        benchmark_classify(options)
+    elif remainder == ['ois']:
+        benchmark_ois(options)
+    elif remainder == ['copy']:
+        benchmark_copy(options)
+    else:
+        parser.error('a benchmark to run must be given')
@@ -0,0 +1,178 @@
+# Copyright 2022 University of New South Wales, Ingham Institute
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os, json, sqlite3, struct, threading, zlib
+from datetime import datetime
+
+from datastore import SETTINGS_FILE
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Define path to the SQLite scan catalog, kept next to the YAML settings file
+CATALOG_FILE = os.path.join(os.path.dirname(SETTINGS_FILE), 'catalog.db')
+
+# Increment when the catalog tables change, an out of date catalog is discarded
+CATALOG_VERSION = 3
+
+# Persistent record of the size of each directory found by a scan, along with the
+# modification times of every directory within it. A directory only needs to be
+# walked again if one of these modification times has changed since it was recorded.
+class ScanCatalog:
+
+    def __init__(self, catalog_file=CATALOG_FILE):
+
+        # The catalog may be written to from the scan worker threads
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(catalog_file, check_same_thread=False)
+
+        # The catalog only caches what is on disk, so just start again if it was
+        # created by a different version of this tool
+        if not self.conn.execute('PRAGMA user_version').fetchone()[0] == CATALOG_VERSION:
+            logger.info('Creating new scan catalog in %s', catalog_file)
+            self.conn.execute('DROP TABLE IF EXISTS directories')
+            self.conn.execute('PRAGMA user_version = %d' % CATALOG_VERSION)
+
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS directories (
+            path TEXT NOT NULL,
+            dir_name TEXT NOT NULL,
+            dir_size INTEGER NOT NULL,
+            allocated_size INTEGER NOT NULL,
+            file_count INTEGER NOT NULL,
+            dir_mtimes TEXT NOT NULL,
+            scanned TEXT NOT NULL,
+            manifest BLOB,
+            PRIMARY KEY (path, dir_name))""")
+        self.conn.commit()
+
+    # Return the catalog entries for all directories previously found in path, as
+    # a dict keyed by dir_name
+    def lookup_path(self, path):
+
+        entries = {}
+
+        with self.lock:
+            rows = self.conn.execute('SELECT dir_name, dir_size, allocated_size, file_count, dir_mtimes, manifest IS NOT NULL FROM directories WHERE path = ?', (path,)).fetchall()
+
+        for dir_name, dir_size, allocated_size, file_count, dir_mtimes, has_manifest in rows:
+            entries[dir_name] = {
+                'size': dir_size,
+                'allocated_size': allocated_size,
+                'file_count': file_count,
+                'dir_mtimes': json.loads(dir_mtimes),
+                'has_manifest': bool(has_manifest)
+            }
+
+        return entries
+
+    # Return the manifest of files recorded for a directory, along with the modification
+    # times of its directories, or None if no manifest has been recorded
+    def get_manifest(self, path, dir_name):
+
+        with self.lock:
+            row = self.conn.execute('SELECT dir_mtimes, manifest FROM directories WHERE path = ? AND dir_name = ? AND manifest IS NOT NULL', (path, dir_name)).fetchone()
+
+        if row is None:
+            return None
+
+        return {'dir_mtimes': json.loads(row[0]), 'files': decode_manifest(bytes(row[1]))}
+
+    # Store the size info (as returned by get_size_info) for a directory
+    def update(self, path, dir_name, size_info):
+
+        with self.lock:
+            # Scans of abandoned locations may still finish after the catalog is closed
+            if self.conn is None:
+                return
+
+            manifest = None
+            if 'manifest' in size_info:
+                manifest = sqlite3.Binary(encode_manifest(size_info['manifest']))
+
+            self.conn.execute('INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (path, dir_name, size_info['size'], size_info['allocated_size'], size_info['file_count'],
+                json.dumps(size_info['dir_mtimes']), datetime.now().strftime("%Y-%m-%d %H:%M:%S"), manifest))
+
+    # Remove the entry for a directory, e.g. once it has been archived or deleted
+    def remove(self, path, dir_name):
+
+        with self.lock:
+            if self.conn is None:
+                return
+
+            self.conn.execute('DELETE FROM directories WHERE path = ? AND dir_name = ?', (path, dir_name))
+
+    # Remove entries for directories in path which no longer exist
+    def remove_missing(self, path, dir_names):
+
+        with self.lock:
+            if self.conn is None:
+                return
+
+            rows = self.conn.execute('SELECT dir_name FROM directories WHERE path = ?', (path,)).fetchall()
+            missing = [(path, r[0]) for r in rows if not r[0] in dir_names]
+            self.conn.executemany('DELETE FROM directories WHERE path = ? AND dir_name = ?', missing)
+
+        if len(missing) > 0:
+            logger.debug('Removed %d missing directories in %s from catalog', len(missing), path)
+
+    def close(self):
+
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+            self.conn = None
+
+# Pack a manifest, a list of (relative path, size, mtime) tuples for each file in a
+# directory, into a compact binary form. The sizes and mtimes are stored as columns
+# followed by the NUL separated paths, and the whole thing is compressed.
+def encode_manifest(files):
+
+    rel_paths = [f[0] if isinstance(f[0], bytes) else f[0].encode('utf-8') for f in files]
+
+    data = struct.pack('<I', len(files))
+    data += struct.pack('<%dq' % len(files), *[f[1] for f in files])
+    data += struct.pack('<%dd' % len(files), *[f[2] for f in files])
+    data += b'\0'.join(rel_paths)
+
+    return zlib.compress(data)
+
+# Unpack a manifest packed by encode_manifest
+def decode_manifest(data):
+
+    data = zlib.decompress(data)
+
+    n = struct.unpack_from('<I', data)[0]
+    sizes = struct.unpack_from('<%dq' % n, data, 4)
+    mtimes = struct.unpack_from('<%dd' % n, data, 4 + 8 * n)
+
+    rel_paths = data[4 + 16 * n:].split(b'\0') if n > 0 else []
+    if not str is bytes:
+        rel_paths = [p.decode('utf-8') for p in rel_paths]
+
+    return list(zip(rel_paths, sizes, mtimes))
+
+# Return True if none of the directories recorded in dir_mtimes have been modified
+# (or removed). Adding or removing a file or sub-directory anywhere in the tree
+# changes the modification time of the directory containing it.
+def directory_unchanged(start_path, dir_mtimes):
+
+    try:
+        for rel_path, mtime in dir_mtimes.items():
+            if not os.path.getmtime(os.path.join(start_path, rel_path)) == mtime:
+                return False
+    except OSError:
+        return False
+
+    return True
@@ -12,18 +12,25 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import inspect, timeit
-import _mssql
-import pymssql
+import inspect, json, re, sqlite3, threading, timeit
+from datetime import datetime
+
+# pymssql is only needed by the MSSQL backend
+try:
+    import _mssql
+    import pymssql
+except ImportError:
+    pymssql = None
 
 from datastore import get_datastore
+from workers import thread_map
 
 import logging
 logger = logging.getLogger(__name__)
 
 # SQL Query to retrieve records for patients in a clinical trial
 # TODO Add center specific OIS SQL query in here, '%%%MRN%%%' is replaced with
-# MRN list for query.
+# MRN list for query, e.g. ... WHERE Patient.PatientId IN ('%%%MRN%%%')
 QUERY_CLINICAL_TRIALS = """"""
 
 # SQL Query to retrieve records for patients who have finished treatment
@@ -36,77 +43,510 @@ QUERY_PATIENT_FINISHED_TREATMENT = """"""
 # MRN list for query.
 QUERY_PATIENT_HAS_4D = """"""
 
-# Perform the query on OIS to fetch clinical trials
-def fetch_clinical_trials(mrns):
 
-    if len(QUERY_CLINICAL_TRIALS) == 0:
+# Perform the query on OIS to fetch clinical trials for a list of MRNs, see
+# query_ois_batched for row_handler
+def fetch_clinical_trials(mrns, row_handler=None):
+
+    query = get_backend().queries.get('clinical_trials', QUERY_CLINICAL_TRIALS)
+
+    if len(query) == 0:
         logger.error("OIS query missing, please add in database.py")
         return ""
 
-    return query_ois(QUERY_CLINICAL_TRIALS.replace('%%%MRN%%%',mrns))
+    return query_ois_batched(query, mrns, row_handler, 'clinical_trials')
+
+# Perform the query on OIS to fetch finished treatments for a list of MRNs
+def fetch_patient_finished_treatment(mrns, row_handler=None):
 
-# Perform the query on OIS to fetch finished treatments
-def fetch_patient_finished_treatment(mrns):
+    query = get_backend().queries.get('finished_treatment', QUERY_PATIENT_FINISHED_TREATMENT)
 
-    if len(QUERY_PATIENT_FINISHED_TREATMENT) == 0:
+    if len(query) == 0:
         logger.error("OIS query missing, please add in database.py")
         return ""
 
-    return query_ois(QUERY_PATIENT_FINISHED_TREATMENT.replace('%%%MRN%%%',mrns))
+    return query_ois_batched(query, mrns, row_handler, 'finished_treatment')
+
+# Perform the query on OIS to fetch 4d cone beams for a list of MRNs
+def fetch_patient_has_4d(mrns, row_handler=None):
 
-# Perform the query on OIS to fetch 4d cone beams
-def fetch_patient_has_4d(mrns):
+    query = get_backend().queries.get('has_4d', QUERY_PATIENT_HAS_4D)
 
-    if len(QUERY_PATIENT_HAS_4D) == 0:
+    if len(query) == 0:
         logger.error("OIS query missing, please add in database.py")
         return ""
 
-    return query_ois(QUERY_PATIENT_HAS_4D.replace('%%%MRN%%%',mrns))
+    return query_ois_batched(query, mrns, row_handler, 'has_4d')
 
-# Perform the query on OIS and return the results as a dict
-def query_ois(query):
+# Split a list of MRNs into batches of at most batch_size
+def batch_mrns(mrns, batch_size):
+    return [mrns[i:i + batch_size] for i in range(0, len(mrns), batch_size)]
+
+# Smaller numbers of MRN parameters that queries of only a few MRNs are padded to, rather
+# than padding them to the full batch size
+MRN_PARAMETER_BUCKETS = (10, 100)
+
+# Return the number of MRN parameters used to query num_mrns MRNs. This is one of a few
+# fixed sizes so that the query text, and so its plan, is the same from night to night
+# whatever the number of MRNs being checked.
+def mrn_parameter_count(num_mrns, batch_size):
+
+    for bucket in MRN_PARAMETER_BUCKETS:
+        if num_mrns <= bucket < batch_size:
+            return bucket
+
+    return batch_size
+
+# Replace the '%%%MRN%%%' placeholder in a query with a list of parameter placeholders
+def replace_mrn_placeholder(query, param_names):
+
+    # The placeholder is normally inside quotes, as it was replaced with a joined string
+    return query.replace("'%%%MRN%%%'", '%%%MRN%%%').replace('%%%MRN%%%', ', '.join(param_names))
+
+# OIS backend for Microsoft SQL Server (e.g. MOSAIQ), queried with pymssql using the
+# QUERY_* queries above
+class MSSQLBackend:
+
+    # SQL type of the MRN query parameters, unless set by ois_config['mrn_parameter_type'].
+    # This should match the type of the MRN column (e.g. IDA) so that SQL Server can seek
+    # its index. If the types differ the column may be converted to the parameter's type
+    # for every row, which happens when an nvarchar parameter is compared to a varchar
+    # column. A varchar parameter is only converted once when compared to an nvarchar
+    # column, so varchar is the default.
+    MRN_PARAMETER_TYPE = 'varchar(50)'
+
+    def __init__(self, ois_config):
+
+        self.ois_config = ois_config
+
+        self.mrn_parameter_type = ois_config.get('mrn_parameter_type', self.MRN_PARAMETER_TYPE)
+        if not re.match(r'^\w+(\(\w+\))?$', self.mrn_parameter_type):
+            raise ValueError('Invalid OIS MRN parameter type: ' + str(self.mrn_parameter_type))
+
+        # The site specific queries are used
+        self.queries = {}
+
+    def check_config(self):
+
+        if not "host" in self.ois_config or len(self.ois_config['host']) == 0:
+            logger.error("OIS connection configuration missing")
+
+    def connect(self):
+
+        if pymssql is None:
+            raise ImportError('pymssql is required to query OIS')
+
+        return pymssql.connect(server=self.ois_config['host'],
+            user=self.ois_config['user'],
+            password=self.ois_config['pass'],
+            database=self.ois_config['db'])
+
+    # Return a cursor which returns each row as a dict
+    def cursor(self, conn):
+        return conn.cursor(as_dict=True)
+
+    # Turn a query with the '%%%MRN%%%' placeholder into a parameterised query for
+    # batch_size MRNs. The query is run with sp_executesql so that its text, and so the
+    # plan SQL Server compiles for it, is the same for every batch and every scan. Only
+    # the parameter values passed in the EXEC change. Returns the query for pymssql,
+    # which takes the MRNs as its parameters.
+    def parameterise_query(self, query, batch_size):
+
+        param_names = ['@p' + str(i) for i in range(batch_size)]
+
+        statement = replace_mrn_placeholder(query, param_names)
+
+        definitions = ', '.join([p + ' ' + self.mrn_parameter_type for p in param_names])
+        values = ', '.join([p + ' = %s' for p in param_names])
+
+        # The statement is passed as a string literal, and pymssql substitutes the
+        # parameters with % formatting
+        statement = statement.replace("'", "''").replace('%', '%%')
+
+        return "EXEC sp_executesql N'" + statement + "', N'" + definitions + "', " + values
+
+# OIS backend using a local SQLite database in place of OIS, so that the OIS queries and
+# classification can be tested and load tested without an OIS server. The database is
+# created with synthetic_ois.create_synthetic_ois, and ois_config['db'] is its path.
+class SQLiteBackend:
+
+    def __init__(self, ois_config):
+
+        self.ois_config = ois_config
+
+        # Queries of the synthetic OIS tables, returning the columns the QUERY_* queries do
+        self.queries = {
+            'finished_treatment': """
+                SELECT p.IDA, p.Last_Name, p.First_Name, p.MIddle_Name, f.presc_fractions,
+                    COUNT(fx.field_id) AS deliv_fractions,
+                    MAX(fx.tx_date) AS "last_fraction_date [timestamp]"
+                FROM patients p
+                JOIN fields f ON f.IDA = p.IDA
+                LEFT JOIN fractions fx ON fx.field_id = f.field_id
+                WHERE p.IDA IN ('%%%MRN%%%')
+                GROUP BY f.field_id
+                ORDER BY p.IDA, f.field_id""",
+            'clinical_trials': """
+                SELECT p.IDA, p.Last_Name, p.First_Name, p.MIddle_Name, t.trial_name
+                FROM patients p
+                JOIN trials t ON t.IDA = p.IDA
+                WHERE p.IDA IN ('%%%MRN%%%')""",
+            'has_4d': """
+                SELECT DISTINCT p.IDA, p.Last_Name, p.First_Name, p.MIddle_Name
+                FROM patients p
+                JOIN images i ON i.IDA = p.IDA
+                WHERE i.image_type = '4D' AND p.IDA IN ('%%%MRN%%%')"""
+        }
+
+    def check_config(self):
+
+        if not 'db' in self.ois_config or len(self.ois_config['db']) == 0:
+            logger.error("OIS connection configuration missing")
+
+    def connect(self):
+
+        # Connections are shared between the query threads, though only used by one at a time
+        conn = sqlite3.connect(self.ois_config['db'], detect_types=sqlite3.PARSE_COLNAMES,
+            check_same_thread=False)
+        conn.row_factory = lambda cursor, row: dict(zip([d[0] for d in cursor.description], row))
+
+        return conn
+
+    def cursor(self, conn):
+        return conn.cursor()
+
+    def parameterise_query(self, query, batch_size):
+        return replace_mrn_placeholder(query, ['?'] * batch_size)
+
+# The OIS backends which can be selected with ois_config['backend']
+OIS_BACKENDS = {'mssql': MSSQLBackend, 'sqlite': SQLiteBackend}
+
+# Create the backend configured in ois_config, MSSQL by default
+def create_backend(ois_config):
+
+    backend = ois_config.get('backend', 'mssql')
+
+    if not backend in OIS_BACKENDS:
+        raise ValueError('Unknown OIS backend: ' + str(backend))
+
+    return OIS_BACKENDS[backend](ois_config)
+
+# Return the backend of the open session, or the configured backend if there isn't one
+def get_backend():
+
+    if ois_pool:
+        return ois_pool.backend
+
+    return create_backend(get_datastore()['ois_config'])
+
+# Perform the query on OIS for the MRNs in batches, rather than one query with every MRN
+# in it, running the batches in parallel. The results of the batches are merged, if any
+# of the batches fail None is returned as with query_ois. If row_handler is given the
+# rows are passed to it as they are fetched instead (see query_ois), the rows for each
+# MRN all come from the same batch. The name of the query is recorded in the metrics of
+# each batch (see record_query_metrics).
+def query_ois_batched(query, mrns, row_handler=None, name=None):
+
+    if len(mrns) == 0:
+        return 0 if row_handler else []
+
+    datastore = get_datastore()
+
+    batch_size = datastore['ois_mrn_batch_size']
+    batches = batch_mrns(mrns, batch_size)
+
+    # Every batch has the same number of parameters so they all share a query plan
+    batch_size = mrn_parameter_count(len(mrns), batch_size)
+    parameterised_query = get_backend().parameterise_query(query, batch_size)
+
+    def query_batch(batch_index):
+
+        batch = batches[batch_index]
+
+        # Pad the last batch by repeating an MRN, which doesn't change the results
+        params = tuple(batch + [batch[-1]] * (batch_size - len(batch)))
+
+        start_time = timeit.default_timer()
+        result = query_ois(parameterised_query, params, row_handler,
+            {'query': name, 'batch': '%d/%d' % (batch_index + 1, len(batches)), 'mrns': len(batch)})
+
+        logger.info('OIS batch %d of %d (%d MRNs) completed in %s', batch_index + 1, len(batches),
+            len(batch), str(timeit.default_timer() - start_time))
+
+        return result
+
+    results = thread_map(query_batch, range(len(batches)), datastore['ois_query_workers'])
+
+    if None in results:
+        return None
+
+    logger.info('Queried %d MRNs in %d batches', len(mrns), len(batches))
+
+    if row_handler:
+        return sum(results)
+
+    return [row for result in results for row in result]
+
+# Pool of open connections to OIS. Connections are returned to the pool after each query
+# and reused for the next, so a new connection (TLS handshake and login) is only needed
+# if none are free or a connection has stopped working.
+class OISConnectionPool:
+
+    def __init__(self, ois_config):
+
+        self.backend = create_backend(ois_config)
+        self.lock = threading.Lock()
+        self.idle = []
+
+        # Statistics for logging
+        self.connected = 0
+        self.reused = 0
+        self.reconnected = 0
+
+    # Open a new connection to OIS
+    def connect(self):
+
+        start_time = timeit.default_timer()
+
+        conn = self.backend.connect()
+
+        self.connected += 1
+        logger.info('Connected to OIS in ' + str(timeit.default_timer() - start_time))
+
+        return conn
+
+    # Check that a connection is still usable
+    def is_healthy(self, conn):
+
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.fetchall()
+            return True
+        except Exception:
+            return False
+
+    # Get a connection from the pool, opening a new one if none are free
+    def get(self):
+
+        with self.lock:
+            conn = self.idle.pop() if len(self.idle) > 0 else None
+
+        if conn:
+            if self.is_healthy(conn):
+                self.reused += 1
+                return conn
+
+            logger.info('OIS connection no longer usable, reconnecting')
+            self.reconnected += 1
+            self.discard(conn)
+
+        return self.connect()
+
+    # Return a connection to the pool once a query is finished with it
+    def put(self, conn):
+
+        with self.lock:
+            self.idle.append(conn)
+
+    # Close a connection which shouldn't be used again
+    def discard(self, conn):
+
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    # Close all connections in the pool
+    def close(self):
+
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+
+        for conn in idle:
+            self.discard(conn)
+
+        logger.info('OIS connection pool closed. Connections opened: %d, reused: %d, reconnected: %d',
+            self.connected, self.reused, self.reconnected)
+
+# The connection pool used by query_ois while a session is open
+ois_pool = None
+
+# Keep connections to OIS open for reuse by all queries until close_ois_session is called,
+# e.g. for the duration of a scan
+def open_ois_session():
+
+    global ois_pool
 
-    logger.debug(str(query))
     datastore = get_datastore()
+    ois_pool = OISConnectionPool(datastore['ois_config'])
+
+def close_ois_session():
+
+    global ois_pool
+
+    if ois_pool:
+        ois_pool.close()
+        ois_pool = None
+
+# Metrics recorded for each query run, see record_query_metrics
+query_metrics = []
+query_metrics_lock = threading.Lock()
 
-    if not "host" in datastore["ois_config"] or len(datastore['ois_config']['host']) == 0:
-        logger.error("OIS connection configuration missing")
+# File the metrics of each query are written to as they are recorded, one JSON object
+# per line, if set with set_query_metrics_file
+query_metrics_file = None
+
+def set_query_metrics_file(file_name):
+
+    global query_metrics_file
+    query_metrics_file = file_name
+
+# Return the metrics recorded for all queries run so far
+def get_query_metrics():
+
+    with query_metrics_lock:
+        return list(query_metrics)
+
+# Record the metrics of a query. These include the time in seconds to get a connection
+# ('connect'), execute the query ('execute') and fetch the rows ('fetch'), the number
+# of rows, whether the query succeeded, along with anything given by the caller such as
+# the query name, batch and number of MRNs.
+def record_query_metrics(metrics):
+
+    metrics['time'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    datastore = get_datastore()
+    if metrics['total'] >= datastore['ois_slow_query_seconds']:
+        logger.warning('Slow OIS query: ' + str(metrics))
+
+    with query_metrics_lock:
+        query_metrics.append(metrics)
+
+        if query_metrics_file:
+            try:
+                with open(query_metrics_file, 'a') as f:
+                    f.write(json.dumps(metrics, sort_keys=True) + '\n')
+            except IOError:
+                logger.exception('Unable to write OIS query metrics')
+
+# Summarise the query metrics, returning the number of queries, how many failed, the total
+# rows and seconds, and the metrics of queries which took at least slow_seconds
+def summarise_query_metrics(metrics, slow_seconds):
+
+    return {
+        'queries': len(metrics),
+        'failed': len([m for m in metrics if not m['ok']]),
+        'rows': sum([m['rows'] or 0 for m in metrics]),
+        'total': sum([m['total'] for m in metrics]),
+        'slow': [m for m in metrics if m['total'] >= slow_seconds]
+    }
+
+# Fetch the rows of a query's results fetch_size at a time
+def fetch_rows(cursor, fetch_size):
+
+    while True:
+        rows = cursor.fetchmany(fetch_size)
+        if not rows:
+            return
+
+        for row in rows:
+            yield row
+
+# Log a summary of the results of a query, rather than every row
+def log_result_summary(row_count, first_row):
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('%d rows returned, first row: %s', row_count, str(first_row))
+
+# Perform the query on OIS and return the results as a dict. Any params are passed to
+# the database driver to substitute into the query. If row_handler is given, the rows are passed
+# to it as they are fetched, without holding all of the results in memory, and the
+# number of rows is returned instead. row_handler may be called from several threads
+# at once when the queries are run in parallel. The timing of the query is recorded along
+# with any metrics given, see record_query_metrics.
+def query_ois(query, params=None, row_handler=None, metrics=None):
+
+    logger.debug(str(query))
+    if params:
+        logger.debug('%d parameters', len(params))
+    datastore = get_datastore()
 
     if len(query) == 0:
         logger.error("OIS query missing, please add in database.py")
 
+    # Use the session's connection pool if one is open, otherwise connect just for this query
+    pool = ois_pool or OISConnectionPool(datastore['ois_config'])
+    pool.backend.check_config()
+
     conn = None
     result = None
 
+    metrics = dict(metrics or {})
+    metrics.update({'connect': None, 'execute': None, 'fetch': None, 'rows': None, 'ok': False})
+
     start_time = timeit.default_timer()
 
-    # Run query on mssql and return a list of dicts of the results
+    # Run query on OIS and return a list of dicts of the results
     try:
 
         logger.info('Will query OIS')
 
-        conn = pymssql.connect(server=datastore['ois_config']['host'],
-            user=datastore['ois_config']['user'],
-            password=datastore['ois_config']['pass'],
-            database=datastore['ois_config']['db'])
+        conn = pool.get()
+
+        metrics['connect'] = timeit.default_timer() - start_time
+
+        cursor = pool.backend.cursor(conn)
+
+        cursor.execute(query, params)
 
-        cursor = conn.cursor(as_dict=True)
+        metrics['execute'] = timeit.default_timer() - start_time - metrics['connect']
 
-        cursor.execute(query)
+        if row_handler:
+            result = 0
+            first_row = None
 
-        result = cursor.fetchall()
+            for row in fetch_rows(cursor, datastore['ois_fetch_size']):
+                if result == 0:
+                    first_row = row
+                row_handler(row)
+                result += 1
+
+            log_result_summary(result, first_row)
+
+        else:
+            result = cursor.fetchall()
+            log_result_summary(len(result), result[0] if len(result) > 0 else None)
+
+        # When rows are streamed this includes the time taken to handle them
+        metrics['fetch'] = timeit.default_timer() - start_time - metrics['connect'] - metrics['execute']
+        metrics['rows'] = result if row_handler else len(result)
+        metrics['ok'] = True
 
     except:
         logger.exception('Exception with query')
 
+        # Any rows already passed to row_handler are incomplete
+        result = None
+
+        # Don't reuse a connection which may have caused the exception
+        if conn:
+            pool.discard(conn)
+            conn = None
+
     finally:
         if conn:
-            conn.close()
+            if pool is ois_pool:
+                pool.put(conn)
+            else:
+                pool.discard(conn)
 
     query_duration = timeit.default_timer() - start_time
 
     logger.info('Query completed in ' + str(query_duration))
 
-    logger.debug(str(result))
+    metrics['total'] = query_duration
+    record_query_metrics(metrics)
 
     return result
@@ -42,6 +42,72 @@ def get_datastore():
     if not 'email_reports_config' in datastore:
         datastore['email_reports_config'] = {}
 
+    # Number of patient directories to compute the size of at the same time
+    if not 'scan_workers' in datastore:
+        datastore['scan_workers'] = 4
+
+    # Keep a catalog of directory sizes so unchanged directories aren't walked again
+    if not 'scan_catalog' in datastore:
+        datastore['scan_catalog'] = True
+
+    # Seconds without progress before an XVI location is assumed to have stopped responding
+    if not 'scan_location_timeout' in datastore:
+        datastore['scan_location_timeout'] = 600
+
+    # Number of files sampled in each directory when estimating directory sizes
+    if not 'estimate_samples_per_dir' in datastore:
+        datastore['estimate_samples_per_dir'] = 20
+
+    # Number of patient directories to archive or delete at the same time
+    if not 'archive_workers' in datastore:
+        datastore['archive_workers'] = 2
+
+    # Number of files within a patient directory to copy at the same time
+    if not 'copy_workers' in datastore:
+        datastore['copy_workers'] = 4
+
+    # Checksum computed for each file as it is archived (any hashlib algorithm) and checked
+    # against the archived copy, also saved alongside it. If empty, only the size of the
+    # archived directory is checked.
+    if not 'archive_checksum' in datastore:
+        datastore['archive_checksum'] = 'md5'
+
+    # Record a manifest of every file during the scan, used to copy and verify archives
+    if not 'scan_manifests' in datastore:
+        datastore['scan_manifests'] = False
+
+    # Number of MRNs in each OIS query, and how many of these queries to run at once. SQL
+    # Server allows up to 2100 parameters in a query.
+    if not 'ois_mrn_batch_size' in datastore:
+        datastore['ois_mrn_batch_size'] = 500
+
+    if not 'ois_query_workers' in datastore:
+        datastore['ois_query_workers'] = 2
+
+    # Number of rows fetched from OIS at a time
+    if not 'ois_fetch_size' in datastore:
+        datastore['ois_fetch_size'] = 1000
+
+    # OIS queries taking at least this many seconds are reported as slow
+    if not 'ois_slow_query_seconds' in datastore:
+        datastore['ois_slow_query_seconds'] = 30
+
+    # Cache OIS results, for days for patients whose treatment finished a while ago and
+    # for hours for everyone else
+    if not 'ois_cache' in datastore:
+        datastore['ois_cache'] = True
+
+    if not 'ois_cache_settled_days' in datastore:
+        datastore['ois_cache_settled_days'] = 30
+
+    if not 'ois_cache_active_hours' in datastore:
+        datastore['ois_cache_active_hours'] = 12
+
+    # Days beyond the 2 weeks after their last fraction that a patient's treatment is
+    # checked each scan before it is treated as settled
+    if not 'ois_settle_margin_days' in datastore:
+        datastore['ois_settle_margin_days'] = 7
+
     return datastore
 
 # Write YAML from the datastore file
@@ -0,0 +1,117 @@
+# Copyright 2022 University of New South Wales, Ingham Institute
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os, json, sqlite3, threading, time
+from datetime import datetime
+
+from datastore import SETTINGS_FILE
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Define path to the SQLite OIS cache, kept next to the YAML settings file. This is kept
+# apart from the scan catalog since the two are written to at the same time during a scan.
+OIS_CACHE_FILE = os.path.join(os.path.dirname(SETTINGS_FILE), 'ois_cache.db')
+
+# Increment when the cache table changes, an out of date cache is discarded
+OIS_CACHE_VERSION = 2
+
+# Format used to store dates in the cached OIS results
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+# Persistent record of the OIS results for each MRN (as summarised by
+# tools.index_ois_results), along with when OIS was last checked for them and the action
+# they were last classified with. Results for patients whose treatment is settled change
+# rarely so need not be checked again for some time.
+class OISCache:
+
+    def __init__(self, cache_file=OIS_CACHE_FILE):
+
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(cache_file, check_same_thread=False)
+
+        if not self.conn.execute('PRAGMA user_version').fetchone()[0] == OIS_CACHE_VERSION:
+            logger.info('Creating new OIS cache in %s', cache_file)
+            self.conn.execute('DROP TABLE IF EXISTS ois_results')
+            self.conn.execute('PRAGMA user_version = %d' % OIS_CACHE_VERSION)
+
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS ois_results (
+            mrn TEXT PRIMARY KEY,
+            info TEXT NOT NULL,
+            action TEXT,
+            checked REAL NOT NULL)""")
+        self.conn.commit()
+
+    # Return the cache entries for the MRNs, as a dict keyed by MRN. Each entry contains
+    # the OIS results as 'info', when they were 'checked' (seconds since the epoch) and the
+    # last 'action' the patient was classified with, if any.
+    def lookup(self, mrns):
+
+        entries = {}
+
+        with self.lock:
+            rows = self.conn.execute('SELECT mrn, info, action, checked FROM ois_results').fetchall()
+
+        mrns = set(mrns)
+        for mrn, info, action, checked in rows:
+            if mrn in mrns:
+                entries[mrn] = {'info': decode_info(info), 'action': action, 'checked': checked}
+
+        return entries
+
+    # Store the OIS results just checked for each of the MRNs, a dict keyed by MRN. The
+    # patients are classified again once the results are stored, see record_actions.
+    def update(self, infos):
+
+        now = time.time()
+
+        with self.lock:
+            self.conn.executemany('INSERT OR REPLACE INTO ois_results VALUES (?, ?, NULL, ?)',
+                [(mrn, encode_info(info), now) for mrn, info in infos.items()])
+            self.conn.commit()
+
+    # Store the action each patient was classified with, a dict keyed by MRN
+    def record_actions(self, actions):
+
+        with self.lock:
+            self.conn.executemany('UPDATE ois_results SET action = ? WHERE mrn = ?',
+                [(action, mrn) for mrn, action in actions.items()])
+            self.conn.commit()
+
+    def close(self):
+
+        with self.lock:
+            self.conn.close()
+            self.conn = None
+
+# Store the datetimes in OIS results as strings so they can be saved as JSON
+def encode_info(info):
+
+    def encode_date(d):
+        if isinstance(d, datetime):
+            return d.strftime(DATE_FORMAT)
+        raise TypeError(repr(d) + ' is not JSON serializable')
+
+    return json.dumps(info, default=encode_date)
+
+# Read OIS results saved by encode_info
+def decode_info(data):
+
+    info = json.loads(data)
+
+    treatment = info.get('treatment')
+    if treatment and treatment['last_fraction_date']:
+        treatment['last_fraction_date'] = datetime.strptime(treatment['last_fraction_date'], DATE_FORMAT)
+
+    return info
@@ -31,7 +31,8 @@ import datetime, logging, sys, os, decimal, subprocess, yaml, Queue
 
 from optparse import OptionParser
 
-from tools import ScanPathsTask, PerformActionTask, send_email_report, is_xvi_running
+from database import set_query_metrics_file
+from tools import ScanPathsTask, PerformActionTask, send_email_report, is_xvi_running, SCAN_QUICK, SCAN_FULL, SCAN_CANDIDATES, SCAN_ESTIMATE
 
 # Load the release info to log the current version number
 try:
@@ -53,6 +54,9 @@ except TypeError:
         if not os.path.isdir(os.path.dirname(log_file_name)):
             raise
 
+# Metrics of each OIS query are written next to the log file
+set_query_metrics_file(os.path.splitext(log_file_name)[0] + '_ois_metrics.jsonl')
+
 logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)s - %(levelname)s - %(message)s',
                     datefmt='%a, %d %b %Y %H:%M:%S',
@@ -117,10 +121,24 @@ if __name__ == "__main__":
                       default=False,
                       action="store_true",
                       )
+    parser.add_option('--scan-mode',
+                      dest="scan_mode",
+                      default=SCAN_QUICK, # Quick by default since file sizes are only used in the email report
+                      type="choice",
+                      choices=[SCAN_QUICK, SCAN_ESTIMATE, SCAN_CANDIDATES, SCAN_FULL],
+                      )
+    parser.add_option('--refresh-ois',
+                      dest="refresh_ois",
+                      default=False,
+                      action="store_true",
+                      help="query OIS for every patient rather than using cached results",
+                      )
     options, remainder = parser.parse_args()
     perform_archive = options.perform_archive
     auto_run = options.auto_run
     shutdown = options.shutdown
+    scan_mode = options.scan_mode
+    refresh_ois = options.refresh_ois
     
     logger.info('Will automatically perform archive operation: ' + str(perform_archive))
     
@@ -133,7 +151,7 @@ if __name__ == "__main__":
         errors = []
         
         queue = Queue.Queue()
-        scan_task = ScanPathsTask(queue, True) # Do this as a quick scan since file sizes aren't used
+        scan_task = ScanPathsTask(queue, scan_mode, refresh_ois)
         scan_task.start()
         scan_task.join()
         
@@ -188,6 +206,10 @@ if __name__ == "__main__":
                     if archived_dirs == None:
                         errors.append('Archive Failed: An unknown error occurred during archiving of data. Please report this to the Medical Physics team for investigation.')
                         
+            elif type(msg) == dict and 'scan_batch' in msg:
+                # Directories found while scanning, only the final list is used here
+                continue
+
             elif type(msg) == dict:
                 # if it's a dict then its returning an error message to log
                 logger.error('The following error occurred while scanning the directories')
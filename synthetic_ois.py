@@ -0,0 +1,101 @@
+# Copyright 2022 University of New South Wales, Ingham Institute
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os, random, sqlite3
+from datetime import datetime, timedelta
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Create a SQLite database of synthetic OIS data for use with the SQLite OIS backend (see
+# database.SQLiteBackend). Each patient has a number of treatment fields, each with a
+# prescribed number of fractions, and the fractions delivered for each field:
+# - finished_fraction of the patients have had all of their fractions delivered
+# - treating_fraction are part way through treatment, with a recent last fraction
+# - the rest have no treatment fields yet
+# Some patients are also on clinical trials or have 4D cone beam images. Returns the list
+# of MRNs created.
+def create_synthetic_ois(db_file, num_patients, fields_per_patient=2, finished_fraction=0.7,
+        treating_fraction=0.2, trial_fraction=0.05, has_4d_fraction=0.1, seed=0):
+
+    rnd = random.Random(seed)
+    now = datetime.now()
+
+    if os.path.exists(db_file):
+        os.remove(db_file)
+
+    conn = sqlite3.connect(db_file)
+    conn.execute('CREATE TABLE patients (IDA TEXT PRIMARY KEY, Last_Name TEXT, First_Name TEXT, MIddle_Name TEXT)')
+    conn.execute('CREATE TABLE fields (field_id INTEGER PRIMARY KEY, IDA TEXT, presc_fractions INTEGER)')
+    conn.execute('CREATE TABLE fractions (field_id INTEGER, tx_date TIMESTAMP)')
+    conn.execute('CREATE TABLE trials (IDA TEXT, trial_name TEXT)')
+    conn.execute('CREATE TABLE images (IDA TEXT, image_type TEXT)')
+
+    mrns = [str(mrn) for mrn in rnd.sample(range(1000000, 9999999), num_patients)]
+
+    field_id = 0
+    for start in range(0, num_patients, 10000):
+
+        patients = []
+        fields = []
+        fractions = []
+
+        for mrn in mrns[start:start + 10000]:
+
+            patients.append((mrn, 'Last' + mrn, 'First', ''))
+
+            status = rnd.random()
+            if status >= finished_fraction + treating_fraction:
+                continue
+
+            finished = status < finished_fraction
+
+            # Fractions are delivered daily up until the last one
+            if finished:
+                last_date = now - timedelta(days=rnd.randint(1, 1500))
+            else:
+                last_date = now - timedelta(days=rnd.randint(0, 7))
+
+            for f in range(rnd.randint(1, 2 * fields_per_patient - 1)):
+
+                field_id += 1
+                presc = rnd.randint(1, 35)
+                fields.append((field_id, mrn, presc))
+
+                delivered = presc if finished else rnd.randint(0, presc - 1)
+                for fx in range(delivered):
+                    tx_date = last_date - timedelta(days=delivered - fx - 1)
+                    fractions.append((field_id, tx_date.strftime('%Y-%m-%d %H:%M:%S')))
+
+        conn.executemany('INSERT INTO patients VALUES (?, ?, ?, ?)', patients)
+        conn.executemany('INSERT INTO fields VALUES (?, ?, ?)', fields)
+        conn.executemany('INSERT INTO fractions VALUES (?, ?)', fractions)
+
+    conn.executemany('INSERT INTO trials VALUES (?, ?)',
+        [(mrn, 'TRIAL') for mrn in rnd.sample(mrns, int(num_patients * trial_fraction))])
+    conn.executemany('INSERT INTO images VALUES (?, ?)',
+        [(mrn, '4D') for mrn in rnd.sample(mrns, int(num_patients * has_4d_fraction))])
+
+    # Indexes as the OIS would have on these columns
+    conn.execute('CREATE INDEX fields_ida ON fields (IDA)')
+    conn.execute('CREATE INDEX fractions_field_id ON fractions (field_id)')
+    conn.execute('CREATE INDEX trials_ida ON trials (IDA)')
+    conn.execute('CREATE INDEX images_ida ON images (IDA)')
+
+    conn.commit()
+    conn.close()
+
+    logger.info('Created synthetic OIS with %d patients and %d fields in %s', num_patients, field_id, db_file)
+
+    return mrns
@@ -12,20 +12,50 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import os, threading, Queue, time, yaml, shutil, smtplib
+import os, stat, math, random, threading, Queue, time, timeit, yaml, shutil, smtplib
 from datetime import datetime, timedelta
 from email.mime.application import MIMEApplication
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
 from datastore import get_datastore
-from database import fetch_clinical_trials, fetch_patient_finished_treatment, fetch_patient_has_4d
+from database import fetch_clinical_trials, fetch_patient_finished_treatment, fetch_patient_has_4d, open_ois_session, close_ois_session
+from database import get_query_metrics, summarise_query_metrics
+from workers import thread_imap, thread_map
+from catalog import ScanCatalog, directory_unchanged
+from archive import CopyJournal, copy_tree, copy_from_manifest, verify_against_manifest, verify_checksums, write_checksums
+from ois_cache import OISCache
 
 import os, subprocess
 
+try:
+    # Python 3.5+
+    from os import scandir
+except ImportError:
+    try:
+        # Python 2 with the scandir package installed
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 import logging
 logger = logging.getLogger(__name__)
 
+# Size of the blocks files are allocated in on disk, used to estimate the allocated size
+# where the file system doesn't report it (e.g. NTFS default cluster size)
+ALLOCATION_UNIT = 4096
+
+# Minimum number of seconds between batches of scan results being sent to the queue
+SCAN_BATCH_INTERVAL = 1.0
+
+# Scan modes: quick doesn't compute any directory sizes, full computes the size of every
+# directory, candidates only computes the size of directories to archive or delete and
+# estimate samples the files in every directory to estimate their size
+SCAN_QUICK = 'quick'
+SCAN_FULL = 'full'
+SCAN_CANDIDATES = 'candidates'
+SCAN_ESTIMATE = 'estimate'
+
 # Return true is the XVI application is currently running
 def is_xvi_running():
     if os.name == 'nt':
@@ -35,15 +65,200 @@ def is_xvi_running():
             
     return False
 
+# List the entries of a directory as (name, path, is_dir, get_stat) tuples, where
+# get_stat() returns the stat info for the entry. Uses scandir where available so
+# whether an entry is a directory comes with the directory listing and files are
+# only stat'ed when get_stat() is called (and on Windows not even then). Links are only
+# followed if follow_links is True.
+def list_dir_types(dir_path, follow_links=False):
+    if scandir:
+        for entry in scandir(dir_path):
+            is_dir = entry.is_dir(follow_symlinks=follow_links)
+            yield entry.name, entry.path, is_dir, lambda entry=entry: entry.stat(follow_symlinks=follow_links)
+    else:
+        for name in os.listdir(dir_path):
+            path = os.path.join(dir_path, name)
+            st = os.stat(path) if follow_links else os.lstat(path)
+            yield name, path, stat.S_ISDIR(st.st_mode), lambda st=st: st
+
+# List the entries of a directory as (name, path, is_dir, stat) tuples, fetching the
+# stat info for each entry only once
+def list_dir_entries(dir_path, follow_links=False):
+    for name, path, is_dir, get_stat in list_dir_types(dir_path, follow_links):
+        yield name, path, is_dir, get_stat()
+
+# Return the space allocated on disk for a file
+def get_allocated_size(st):
+    if hasattr(st, 'st_blocks'):
+        return st.st_blocks * 512
+    return -(-st.st_size // ALLOCATION_UNIT) * ALLOCATION_UNIT
+
+# Return the latest modification time of a directory and its immediate sub-directories,
+# or None if they can't be read. New images for a patient are written to a new
+# directory under IMAGES, which changes the modification time of IMAGES.
+def latest_modified(dir_path):
+
+    try:
+        mtimes = [os.stat(dir_path).st_mtime]
+        for name, path, is_dir, get_stat in list_dir_types(dir_path):
+            if is_dir:
+                mtimes.append(get_stat().st_mtime)
+    except OSError:
+        return None
+
+    return max(mtimes)
+
 # Get the size of a directory and all containing files (including all subdirs)
 def get_size(start_path):
+    return get_size_info(start_path)['size']
+
+# Walk a directory once and get the apparent and allocated size and the number of files
+# within it (including all subdirs), along with the modification time of each directory
+# in the tree (relative to start_path). Each file is only stat'ed once. If manifest is
+# True, the relative path, size and mtime of every file is also returned. If any
+# directory can't be listed the walk carries on, but the result is marked as not
+# complete and no manifest is returned. If follow_links is True, links are followed as
+# they are when archiving (see archive.list_tree).
+def get_size_info(start_path, manifest=False, follow_links=False):
     total_size = 0
-    for dirpath, dirnames, filenames in os.walk(start_path):
-        for f in filenames:
-            fp = os.path.join(dirpath, f)
-            total_size += os.path.getsize(fp)
-    return total_size
+    allocated_size = 0
+    file_count = 0
+    complete = True
+    dir_mtimes = {}
+    files = []
+
+    # The directory may have been removed since it was found
+    try:
+        dir_mtimes[os.curdir] = os.stat(start_path).st_mtime
+        dirs = [(start_path, os.curdir)]
+    except OSError:
+        logger.warning('Unable to read directory %s', start_path)
+        complete = False
+        dirs = []
+    while dirs:
+        dir_path, rel_dir = dirs.pop()
+
+        try:
+            entries = list(list_dir_entries(dir_path, follow_links))
+        except OSError:
+            # Same as os.walk, skip directories which can't be listed
+            logger.warning('Unable to list directory %s', dir_path)
+            complete = False
+            continue
+
+        for name, path, is_dir, st in entries:
+            if is_dir:
+                rel_path = os.path.normpath(os.path.join(rel_dir, name))
+                dir_mtimes[rel_path] = st.st_mtime
+                dirs.append((path, rel_path))
+            else:
+                total_size += st.st_size
+                allocated_size += get_allocated_size(st)
+                file_count += 1
+                if manifest:
+                    files.append((os.path.normpath(os.path.join(rel_dir, name)), st.st_size, st.st_mtime))
+
+    size_info = {'size': total_size, 'allocated_size': allocated_size, 'file_count': file_count,
+        'dir_mtimes': dir_mtimes, 'complete': complete}
+    if manifest and complete:
+        size_info['manifest'] = files
+    return size_info
+
+# Estimate the size of a directory (including all subdirs) by only stat'ing up to
+# samples_per_dir randomly chosen files in each directory and extrapolating to the number
+# of files in the directory. Along with the estimated sizes, the standard deviation of the
+# estimated size is returned so confidence bounds can be given, see format_total_size.
+def estimate_size_info(start_path, samples_per_dir):
+    total_size = 0.0
+    allocated_size = 0.0
+    variance = 0.0
+    file_count = 0
+
+    # Seed with the path so estimates are repeatable between scans
+    rnd = random.Random(start_path)
+
+    # At least 2 files must be sampled to estimate the variance of a directory's size
+    samples_per_dir = max(2, samples_per_dir)
+
+    dirs = [start_path]
+    while dirs:
+        dir_path = dirs.pop()
+
+        try:
+            entries = list(list_dir_types(dir_path))
+        except OSError:
+            logger.warning('Unable to list directory %s', dir_path)
+            continue
+
+        files = []
+        for name, path, is_dir, get_stat in entries:
+            if is_dir:
+                dirs.append(path)
+            else:
+                files.append(get_stat)
+
+        n = len(files)
+        if n == 0:
+            continue
+        file_count += n
+
+        sample = files if n <= samples_per_dir else rnd.sample(files, samples_per_dir)
+        stats = [get_stat() for get_stat in sample]
+        sizes = [st.st_size for st in stats]
+        k = len(sizes)
+
+        mean = sum(sizes) / float(k)
+        total_size += mean * n
+        allocated_size += sum(get_allocated_size(st) for st in stats) / float(k) * n
+
+        # Variance of the estimated total for sampling without replacement, which is
+        # zero when every file in the directory was sampled
+        if k < n:
+            sample_variance = sum((s - mean) ** 2 for s in sizes) / (k - 1)
+            variance += n * n * sample_variance / k * (1 - k / float(n))
+
+    return {'size': int(total_size), 'allocated_size': int(allocated_size), 'file_count': file_count,
+        'size_sd': math.sqrt(variance), 'estimated': True}
+
+# Return the total size of the directories in GB as a string. If any of the sizes were
+# estimated, the total is given with its 95% confidence bounds.
+def format_total_size(directories):
+
+    total_size = sum(d['dir_size'] for d in directories)
+    text = "{:.1f}".format(total_size/1024.0/1024.0/1024.0) + "GB"
+
+    if any(d['size_estimated'] for d in directories):
+        margin = 1.96 * math.sqrt(sum(d['dir_size_sd'] ** 2 for d in directories))
+        text = '~' + text + " (+/- " + "{:.1f}".format(margin/1024.0/1024.0/1024.0) + "GB)"
+
+    return text
     
+# Format the summary of the OIS query metrics (see summarise_query_metrics) for the
+# email report
+def format_ois_summary(summary, slow_seconds):
+
+    if summary['queries'] == 0:
+        return 'No OIS queries were run\n\n'
+
+    text = 'OIS was queried %d times (%d failed), returning %d rows in %.1f seconds\n' % (
+        summary['queries'], summary['failed'], summary['rows'], summary['total'])
+
+    if len(summary['slow']) > 0:
+        text += 'The following OIS queries took longer than %s seconds:\n' % str(slow_seconds)
+        for m in summary['slow']:
+            text += ' - %s batch %s (%s MRNs): %.1f seconds, connect %s, execute %s, fetch %s\n' % (
+                m.get('query'), m.get('batch'), m.get('mrns'), m['total'],
+                format_seconds(m['connect']), format_seconds(m['execute']), format_seconds(m['fetch']))
+
+    return text + '\n'
+
+def format_seconds(seconds):
+
+    if seconds is None:
+        return '-'
+
+    return '%.1fs' % seconds
+
 def send_email_report(directories, archived, deleted, errors, job_start, job_finish, log_file_name):
 
     datastore = get_datastore()
@@ -73,6 +288,10 @@ def send_email_report(directories, archived, deleted, errors, job_start, job_fin
         text += 'MRN\t\tName\n'
         for d in delete_dirs:
             text += d['mrn'] + '\t' + d['name'] + '\n'
+
+        # Sizes are only known if they were computed during the scan
+        if sum(d['dir_size'] for d in delete_dirs) > 0:
+            text += 'Total size: ' + format_total_size(delete_dirs) + '\n'
             
     else:
         text += 'No patients were detected for deletion\n'
@@ -84,9 +303,15 @@ def send_email_report(directories, archived, deleted, errors, job_start, job_fin
         text += 'MRN\t\tName\n'
         for d in archived:
             text += d['mrn'] + '\t' + d['name'] + '\n'
+
+        if sum(d['dir_size'] for d in archived) > 0:
+            text += 'Total size: ' + format_total_size(archived) + '\n'
         text += '\nImportant: Patients listed as archived will not appear on subsequent email reports!\n\n'
     else:
         text += 'No patients were archived\n\n'
+
+    text += format_ois_summary(summarise_query_metrics(get_query_metrics(), datastore['ois_slow_query_seconds']),
+        datastore['ois_slow_query_seconds'])
         
     # Attach the log file
     try:
@@ -155,18 +380,234 @@ def backup_xvi_sql():
             shutil.rmtree(os.path.join(backup_dir,d))
 
 
+# Format a patient's name from a row of one of the OIS queries
+def patient_name(row):
+    return row['Last_Name'] + ' ' + row['First_Name'] + ' ' + row['MIddle_Name']
+
+# Add a row of the finished treatment query to the summary of the OIS results for its
+# MRN (see index_ois_results). The treatment summary records the patient's name (from
+# their last row), the date of their last fraction and whether all of the prescribed
+# fractions have been delivered for every one of their treatment fields.
+def add_treatment_row(index, ft):
+
+    info = index.setdefault(ft['IDA'], {})
+
+    treatment = info.get('treatment')
+    if treatment is None:
+        treatment = info['treatment'] = {'last_fraction_date': None, 'fractions_delivered': True}
+
+    treatment['name'] = patient_name(ft)
+
+    # If a fields last_fraction_date has already been assigned update it if this one is newer.
+    # Fields without any fractions delivered have no last_fraction_date.
+    if type(treatment['last_fraction_date']) == datetime:
+        if type(ft['last_fraction_date']) == datetime and ft['last_fraction_date'] > treatment['last_fraction_date']:
+            treatment['last_fraction_date'] = ft['last_fraction_date']
+    else:
+        treatment['last_fraction_date'] = ft['last_fraction_date']
+
+    # If the prescribed fractions doesn't match the delivered fractions for this field, then
+    # the treatment is not finished
+    if not ft['presc_fractions'] == ft['deliv_fractions']:
+        treatment['fractions_delivered'] = False
+
+# Add a row of the clinical trial or 4D query to the summary of the OIS results for its
+# MRN, only the name from the first row found is kept
+def add_flag_row(index, key, row):
+
+    info = index.setdefault(row['IDA'], {})
+
+    if not key in info:
+        info[key] = patient_name(row)
+
+# Summarise the results of the three OIS queries by MRN in a single pass over each, so
+# that patients can be classified without searching the results for their rows. Each
+# MRN with any rows maps to a dict which may contain 'treatment' (see add_treatment_row)
+# and the patient's name as 'clinical_trial' and 'has_4d' if they have rows in those.
+def index_ois_results(finished_treatment, clinical_trials, has_4d):
+
+    index = {}
+
+    for ft in finished_treatment:
+        add_treatment_row(index, ft)
+
+    for ct in clinical_trials:
+        add_flag_row(index, 'clinical_trial', ct)
+
+    for h4 in has_4d:
+        add_flag_row(index, 'has_4d', h4)
+
+    return index
+
+# Return True if the OIS results for a patient (see index_ois_results) show that their
+# treatment finished long enough ago that it isn't expected to change, i.e. margin_days
+# after the 2 weeks a treatment must have finished for
+def treatment_settled(info, margin_days=0):
+
+    treatment = info.get('treatment')
+
+    if not treatment or not treatment['fractions_delivered']:
+        return False
+
+    if not type(treatment['last_fraction_date']) == datetime:
+        return False
+
+    return treatment['last_fraction_date'] < datetime.now()-timedelta(days=14+margin_days)
+
+# Return why OIS needs to be checked for a patient given their entry in the OIS cache, or
+# None if their cached results can be used. Patients who are new, still being treated or
+# close to the 2 week cutoff for finishing treatment are checked each scan (once their
+# results are older than ois_cache_active_hours), others only every ois_cache_settled_days.
+# Patients whose directories have been modified (see latest_modified) since they were
+# last checked, e.g. by images from a new course of treatment, are always checked, as are
+# those whose modification time (modified) couldn't be read.
+def ois_check_reason(entry, datastore, modified):
+
+    if entry is None:
+        return 'new'
+
+    if modified is None or modified > entry['checked']:
+        return 'directory changed'
+
+    age = time.time() - entry['checked']
+
+    if treatment_settled(entry['info'], datastore['ois_settle_margin_days']):
+        if age < datastore['ois_cache_settled_days'] * 24 * 60 * 60:
+            return None
+        return 'settled expired'
+
+    if age < datastore['ois_cache_active_hours'] * 60 * 60:
+        return None
+
+    treatment = entry['info'].get('treatment')
+    if treatment and treatment['fractions_delivered']:
+        return 'near cutoff'
+
+    return 'in treatment'
+
+# Set the flags and action for a patient directory from the summary of their OIS results
+# (see index_ois_results)
+def classify_patient(p, info):
+
+    treatment = info.get('treatment')
+
+    # If there are no fields for this patient, assume they are still being treated
+    if treatment:
+        p['name'] = treatment['name']
+        p['last_fraction_date'] = treatment['last_fraction_date']
+        p['finished_treatment'] = treatment['fractions_delivered']
+
+    # If the last fraction date was within the last 2 weeks, do not mark the treatment as finished
+    if type(p['last_fraction_date']) == datetime:
+        if datetime.now()-timedelta(days=14) <= p['last_fraction_date']:
+            p['finished_treatment'] = False
+
+    # If there are any clinical trials then flag for this patient
+    if 'clinical_trial' in info:
+        p['clinical_trial'] = True
+        p['name'] = info['clinical_trial']
+
+    # If there are any 4D entires then flag for this patient
+    if 'has_4d' in info:
+        p['has_4d'] = True
+        p['name'] = info['has_4d']
+
+    # Set the action for this patient directory based on the flags just set
+    if p['finished_treatment']:
+
+        if p['clinical_trial'] or p['has_4d']:
+            p['action'] = 'ARCHIVE'
+        else:
+            p['action'] = 'DELETE'
+
+# Open the OIS cache, or return None if it can't be opened (e.g. it is locked by another
+# scan or corrupt), in which case the scan carries on without it
+def open_ois_cache():
+
+    try:
+        return OISCache()
+    except Exception:
+        logger.exception('Unable to open OIS cache, OIS results will not be cached')
+        return None
+
+# Update the OIS cache by calling func with it. Any error is logged rather than raised,
+# since the cache is only used to avoid querying OIS.
+def update_ois_cache(func):
+
+    cache = open_ois_cache()
+    if not cache:
+        return
+
+    try:
+        func(cache)
+    except Exception:
+        logger.exception('Unable to update OIS cache')
+    finally:
+        cache.close()
+
+# Query OIS for the MRNs and return the summary of their results, keyed by MRN (see
+# index_ois_results), or None if any of the queries failed
+def query_ois_index(mrns):
+
+    index = {}
+
+    # The rows are added to the index by MRN as they are fetched, rather than
+    # holding all of the results (see index_ois_results)
+    index_lock = threading.Lock()
+
+    def index_rows(add_row):
+        def row_handler(row):
+            with index_lock:
+                add_row(row)
+        return row_handler
+
+    # The queries don't depend on each other so run them at the same time, each
+    # with its own connection from the session's pool
+    fetches = [
+        (fetch_patient_finished_treatment, index_rows(lambda row: add_treatment_row(index, row))),
+        (fetch_clinical_trials, index_rows(lambda row: add_flag_row(index, 'clinical_trial', row))),
+        (fetch_patient_has_4d, index_rows(lambda row: add_flag_row(index, 'has_4d', row)))]
+
+    open_ois_session()
+    try:
+        results = thread_map(lambda fetch: fetch[0](mrns, fetch[1]), fetches, len(fetches))
+    finally:
+        close_ois_session()
+
+    # If any queries return None, then OIS probably isn't configured. Patients
+    # can't be classified without all of the results.
+    if None in results:
+        return None
+
+    return index
+
 class ScanPathsTask(threading.Thread):
 
-    def __init__(self, queue, quick_scan):
+    def __init__(self, queue, scan_mode, refresh_ois=False):
         threading.Thread.__init__(self)
         self.queue = queue
-        self.quick_scan = quick_scan
+        self.scan_mode = scan_mode
+        self.refresh_ois = refresh_ois
+        self.ois_cache = False
+        self.ois_entries = {}
         self.abort = False
+        self.abandoned_paths = set()
 
     def stop(self):
         self.abort = True
         logger.info('Stopping location scan')
 
+    # Send a batch of patient directories found so far to the queue, so they can be
+    # displayed while the scan is still running. Copies are sent since the scan will
+    # continue to update the directories.
+    def post_batch(self, patients):
+
+        # Ignore anything from locations which were abandoned while being scanned
+        patients = [p for p in patients if not p['path'] in self.abandoned_paths]
+
+        if len(patients) > 0 and not self.abort:
+            self.queue.put({'scan_batch': [dict(p) for p in patients]})
+
     def run(self):
 
         self.directories = []
@@ -175,10 +616,26 @@ class ScanPathsTask(threading.Thread):
         logger.info('Scanning locations')
         self.get_directories()
 
-        # Get info for patients found in scan
+        # The OIS queries only need the MRNs from the directory names, so query OIS
+        # while the directories are being sized
         logger.info('Fetching patient info')
+        ois_thread = threading.Thread(target=self.query_patient_info)
+        ois_thread.start()
+
+        if self.scan_mode == SCAN_FULL or self.scan_mode == SCAN_ESTIMATE:
+            logger.info('Sizing directories')
+            self.size_locations(self.directories, True)
+
+        ois_thread.join()
+
+        # Classify the patients found in scan
         self.fetch_patient_info()
 
+        # Now the patients have been classified, compute the size of those to be actioned
+        if self.scan_mode == SCAN_CANDIDATES:
+            logger.info('Sizing directories to archive or delete')
+            self.size_locations([d for d in self.directories if d['action'] == 'ARCHIVE' or d['action'] == 'DELETE'], False)
+
         # If the scan was cancelled return an empty list
         if self.abort:
             self.queue.put([])
@@ -193,144 +650,367 @@ class ScanPathsTask(threading.Thread):
     # patient directory or not
     def get_directories(self):
 
-        datastore = get_datastore()
+        self.datastore = get_datastore()
 
-        for p in datastore['xvi_paths']:
+        results = self.scan_locations(self.datastore['xvi_paths'], self.scan_location, self.datastore['scan_location_timeout'])
 
-            try:
-                dirs = [d for d in os.listdir(p) if os.path.isdir(os.path.join(p, d))]
-            except:
-                continue
-            for d in dirs:
+        for p in self.datastore['xvi_paths']:
+            if p in results:
+                self.directories.extend(results[p])
 
-                if self.abort:
-                    break
+        logger.info('Found %d Directories',len(self.directories))
+        logger.debug('Patient Directories: ' + str(self.directories))
 
-                patient = {}
-                patient['path'] = p
-                patient['dir_name'] = d
-                patient['action'] = 'KEEP'
-                patient['finished_treatment'] = False
-                patient['clinical_trial'] = False
-                patient['has_4d'] = False
-                patient['last_fraction_date'] = ""
-
-                if self.quick_scan:
-                    patient['dir_size'] = 0
-                else:
-                    patient['dir_size'] = get_size(os.path.join(p, d))
+    # Compute the size of the patient directories, with each location sized in its own
+    # thread. For a full scan the directories are sent to the queue as they are sized
+    # and the catalog is pruned of directories which no longer exist.
+    def size_locations(self, patients, full_scan):
 
-                # Check if this is a patient directory
-                dir_split = d.split('_')
+        if self.abort:
+            return
 
-                try:
-                    if dir_split[0].lower() == 'patient' and len(dir_split[1]) == 7:
-                        patient['mrn'] = dir_split[1]
-                        patient['name'] = ''
+        paths = [p for p in self.datastore['xvi_paths'] if p in set(d['path'] for d in patients)]
 
-                        # Ignore if in list of MRNs to ignore
-                        if patient['mrn'] in datastore['ignore_mrns']:
-                            patient['action'] = 'IGNORE'
-                    else:
-                        # Not a patient directory
+        self.catalog = self.open_catalog()
+
+        def size_location(p, progress):
+
+            location_patients = [d for d in patients if d['path'] == p]
+            self.size_directories(p, location_patients, self.datastore['scan_workers'], progress, full_scan)
+
+            # Only prune the catalog after a complete scan
+            if full_scan and self.catalog and not self.abort:
+                self.catalog.remove_missing(p, [d['dir_name'] for d in location_patients])
+
+        self.scan_locations(paths, size_location, self.datastore['scan_location_timeout'])
+
+        if self.catalog:
+            self.catalog.close()
+
+        logger.info('Sized %d of %d Directories', len(patients), len(self.directories))
+
+    # Open the scan catalog if it is enabled
+    def open_catalog(self):
+
+        if not self.datastore['scan_catalog']:
+            return None
+
+        try:
+            return ScanCatalog()
+        except Exception:
+            logger.exception('Unable to open scan catalog, all directories will be walked')
+            return None
+
+    # Run func(path, progress) for each path in its own thread, so a slow or unavailable
+    # location doesn't hold up the others, and return a dict of the results for each
+    # path. func should call progress() whenever it gets something done, if it doesn't
+    # do so for timeout seconds the location is assumed to have stopped responding (e.g.
+    # a dead network share) and is abandoned. Locations which fail or are abandoned are
+    # reported as errors in the queue.
+    def scan_locations(self, paths, func, timeout):
+
+        results = {}
+        errors = {}
+        last_progress = {}
+
+        def scan(p):
+            try:
+                results[p] = func(p, lambda: last_progress.__setitem__(p, timeit.default_timer()))
+            except Exception as e:
+                logger.exception('Exception while scanning %s', p)
+                errors[p] = str(e)
+
+        # Locations abandoned by another scan of the locations running at the same time
+        # aren't scanned again
+        paths = [p for p in paths if not p in self.abandoned_paths]
+
+        threads = {}
+        for p in paths:
+            last_progress[p] = timeit.default_timer()
+            threads[p] = threading.Thread(target=scan, args=(p,))
+            # A location which never responds shouldn't stop the tool from exiting
+            threads[p].daemon = True
+            threads[p].start()
+
+        running = list(threads)
+        while len(running) > 0 and not self.abort:
+            threads[running[0]].join(0.1)
+            for p in list(running):
+                if not threads[p].is_alive() or p in self.abandoned_paths:
+                    running.remove(p)
+                elif timeit.default_timer() - last_progress[p] > timeout:
+                    running.remove(p)
+                    self.abandoned_paths.add(p)
+                    errors[p] = 'No response for ' + str(timeout) + ' seconds'
+
+        for p in paths:
+            if p in errors:
+                logger.error('Unable to scan %s: %s', p, errors[p])
+                self.queue.put({'error' : 'Could not scan XVI location', 'msg' : 'The XVI location ' + p + ' could not be scanned and has been skipped.\n\n' + errors[p] })
+            elif p in results:
+                logger.info('Finished scanning %s', p)
+
+        return dict((p, results[p]) for p in results if not p in self.abandoned_paths)
+
+    # Find the directories in a single XVI location
+    def scan_location(self, p, progress):
+
+        dirs = [d for d in os.listdir(p) if os.path.isdir(os.path.join(p, d))]
+        progress()
+
+        patients = []
+        for d in dirs:
+
+            if self.abort:
+                break
+
+            patient = {}
+            patient['path'] = p
+            patient['dir_name'] = d
+            patient['action'] = 'KEEP'
+            patient['finished_treatment'] = False
+            patient['clinical_trial'] = False
+            patient['has_4d'] = False
+            patient['last_fraction_date'] = ""
+            patient['dir_size'] = 0
+            patient['allocated_size'] = 0
+            patient['file_count'] = 0
+            patient['size_estimated'] = False
+            patient['dir_size_sd'] = 0
+
+            # Check if this is a patient directory
+            dir_split = d.split('_')
+
+            try:
+                if dir_split[0].lower() == 'patient' and len(dir_split[1]) == 7:
+                    patient['mrn'] = dir_split[1]
+                    patient['name'] = ''
+
+                    # Ignore if in list of MRNs to ignore
+                    if patient['mrn'] in self.datastore['ignore_mrns']:
                         patient['action'] = 'IGNORE'
-                except:
+                else:
                     # Not a patient directory
                     patient['action'] = 'IGNORE'
+            except:
+                # Not a patient directory
+                patient['action'] = 'IGNORE'
 
-                self.directories.append(patient)
+            patients.append(patient)
 
-        logger.info('Found %d Directories',len(self.directories))
-        logger.debug('Patient Directories: ' + str(self.directories))
+        # If every directory is to be sized they are shown once they have been sized
+        if self.scan_mode == SCAN_QUICK or self.scan_mode == SCAN_CANDIDATES:
+            self.post_batch(patients)
 
-    # Determine if directories contain data for patients who have:
-    # - finished their treatment
-    # - are on a clinical trial
-    # - have some 4D cone beam data
-    def fetch_patient_info(self):
+        return patients
+
+    # Compute the size of each directory found in a location, sizing several directories
+    # at once since most of the time is spent waiting on the file system. If the catalog
+    # is used, directories which haven't changed since the last scan aren't walked again.
+    def size_directories(self, p, patients, num_workers, progress, post_batches=True):
+
+        known = {}
+        if self.catalog:
+            known = self.catalog.lookup_path(p)
+
+        # Manifests of the files in each directory are kept in the catalog for archiving
+        record_manifests = self.catalog and self.datastore['scan_manifests']
+
+        def size_directory(patient):
+
+            dir_path = os.path.join(patient['path'], patient['dir_name'])
+
+            entry = known.get(patient['dir_name'])
+            if entry and (entry['has_manifest'] or not record_manifests) and directory_unchanged(dir_path, entry['dir_mtimes']):
+                return entry, False
+
+            # Estimates aren't stored in the catalog
+            if self.scan_mode == SCAN_ESTIMATE:
+                return estimate_size_info(dir_path, self.datastore['estimate_samples_per_dir']), False
+
+            # Manifests list the files as they will be archived, following links
+            return get_size_info(dir_path, record_manifests, record_manifests), True
+
+        walked = 0
+        batch = []
+        last_batch_time = timeit.default_timer()
+        for i, result in thread_imap(size_directory, patients, num_workers, lambda: self.abort):
+
+            progress()
+            patient = patients[i]
+
+            size_info, changed = result
+            patient['dir_size'] = size_info['size']
+            patient['allocated_size'] = size_info['allocated_size']
+            patient['file_count'] = size_info['file_count']
+            patient['size_estimated'] = size_info.get('estimated', False)
+            patient['dir_size_sd'] = size_info.get('size_sd', 0)
+
+            if changed:
+                walked += 1
+                if self.catalog:
+                    # A directory which couldn't be fully walked is walked again next scan
+                    if size_info['complete']:
+                        self.catalog.update(patient['path'], patient['dir_name'], size_info)
+                    else:
+                        self.catalog.remove(patient['path'], patient['dir_name'])
+
+            # Send the directories sized so far in batches
+            if post_batches:
+                batch.append(patient)
+                if timeit.default_timer() - last_batch_time >= SCAN_BATCH_INTERVAL:
+                    self.post_batch(batch)
+                    batch = []
+                    last_batch_time = timeit.default_timer()
+
+        self.post_batch(batch)
+
+        logger.info('Walked %d of %d directories in %s, others unchanged since last scan', walked, len(patients), p)
+
+    # Query OIS for the patients found in the scan
+    def query_patient_info(self):
+
+        self.ois_index = None
 
         if self.abort:
             return
 
-        mrns = "','".join([p['mrn'] for p in self.directories if 'mrn' in p])
+        mrns = [p['mrn'] for p in self.directories if 'mrn' in p]
 
-        finished_treatment = fetch_patient_finished_treatment(mrns)
-        clinical_trials = fetch_clinical_trials(mrns)
-        has_4d = fetch_patient_has_4d(mrns)
+        # Only query OIS for the MRNs whose results could have changed since they were
+        # last checked, see ois_check_reason
+        cache = None
+        cached = {}
+        if self.datastore['ois_cache']:
+            cache = open_ois_cache()
 
-        # If finished_treatment returns None, then OIS probably isn't configured
-        if finished_treatment == None:
-            self.queue.put({'error' : 'Could not query OIS', 'msg' : 'OIS could not be queried. Check connection settings.' })
-            return
+            if cache:
+                try:
+                    self.ois_entries = cache.lookup(mrns)
+                except Exception:
+                    logger.exception('Unable to read OIS cache, OIS will be queried for every MRN')
+                    cache.close()
+                    cache = None
+
+        if cache:
+            self.ois_cache = True
+
+            if self.refresh_ois:
+                logger.info('Refreshing all OIS results')
+            else:
+                # The latest modification of each cached patient's directories, of which
+                # there may be several in different locations
+                mrn_dirs = {}
+                location_dirs = {}
+                for p in self.directories:
+                    if p.get('mrn') in self.ois_entries:
+                        dir_path = os.path.join(p['path'], p['dir_name'])
+                        mrn_dirs.setdefault(p['mrn'], []).append(dir_path)
+                        location_dirs.setdefault(p['path'], []).append(dir_path)
+
+                # Each location is checked in its own thread, so a location which stops
+                # responding is abandoned as it is when sizing. The modification times of
+                # its directories are then unknown, so their patients are checked in OIS.
+                results = self.scan_locations(sorted(location_dirs),
+                    lambda p, progress: self.location_modified(p, location_dirs[p], progress),
+                    self.datastore['scan_location_timeout'])
+
+                dir_modified = {}
+                for location_modified in results.values():
+                    dir_modified.update(location_modified)
+
+                modified = {}
+                for mrn, paths in mrn_dirs.items():
+                    mtimes = [dir_modified.get(path) for path in paths]
+                    modified[mrn] = None if None in mtimes else max(mtimes)
+
+                reasons = {}
+                for mrn in mrns:
+                    reason = ois_check_reason(self.ois_entries.get(mrn), self.datastore, modified.get(mrn))
+                    if reason:
+                        reasons[reason] = reasons.get(reason, 0) + 1
+                    else:
+                        cached[mrn] = self.ois_entries[mrn]['info']
 
-        for p in self.directories:
+                if len(reasons) > 0:
+                    logger.info('Checking OIS for: ' + ', '.join(['%d %s' % (n, r) for r, n in sorted(reasons.items())]))
 
-            if self.abort:
-                break
+        try:
+            mrns = [mrn for mrn in mrns if not mrn in cached]
+            logger.info('OIS results reused for %d MRNs, querying %d', len(cached), len(mrns))
 
-            if p['action'] == 'IGNORE':
-                continue
+            index = {}
+            if len(mrns) > 0:
 
-            # Get all finished_treatment fields for this patient
-            patient_finished_treatment = [ft for ft in finished_treatment if ft['IDA'] == p['mrn']]
+                index = query_ois_index(mrns)
+                if index is None:
+                    return
 
-            # If there are no fields for this patient, assume they are still being treated,
-            # otherwise assume finished for now
-            if len(patient_finished_treatment) > 0:
-                p['finished_treatment'] = True
+                # MRNs without any rows are cached too since this is a result
+                if cache:
+                    try:
+                        cache.update(dict([(mrn, index.get(mrn, {})) for mrn in mrns]))
+                    except Exception:
+                        logger.exception('Unable to update OIS cache')
 
-            # Iterate over each of the patients treatment fields, to determine the last field
-            # and whether or not their treatment is finished
-            for ft in patient_finished_treatment:
+            index.update(cached)
+            self.ois_index = index
 
-                # Assign the name field
-                p['name'] = ft['Last_Name'] + ' ' + ft['First_Name'] + ' ' + ft['MIddle_Name']
+        finally:
+            if cache:
+                cache.close()
 
-                # If a fields last_fraction_date has already been assigned update it if this one is newer
-                if type(p['last_fraction_date']) == datetime:
-                    if ft['last_fraction_date'] > p['last_fraction_date']:
-                        p['last_fraction_date'] = ft['last_fraction_date']
-                else:
-                    p['last_fraction_date'] = ft['last_fraction_date']
+    # Return the latest modification time of each of the directories in a single XVI
+    # location (see latest_modified), keyed by path
+    def location_modified(self, p, dir_paths, progress):
 
-                # If the prescribed fractions doesn't match the delivered fractions for this field, then
-                # the treatment is not finished
-                if not ft['presc_fractions'] == ft['deliv_fractions']:
-                    p['finished_treatment'] = False
+        modified = {}
+        for i, mtime in thread_imap(latest_modified, dir_paths, self.datastore['scan_workers'],
+                lambda: self.abort or p in self.abandoned_paths):
+            progress()
+            modified[dir_paths[i]] = mtime
 
-            # If the last fraction date was within the last 2 weeks, do not mark the treatment as finished
-            if type(p['last_fraction_date']) == datetime:
-                if datetime.now()-timedelta(days=14) <= p['last_fraction_date']:
-                    p['finished_treatment'] = False
+        return modified
 
+    # Determine if directories contain data for patients who have:
+    # - finished their treatment
+    # - are on a clinical trial
+    # - have some 4D cone beam data
+    def fetch_patient_info(self):
 
-            # Get any clinical trials for this patiet
-            patient_clinical_trials = [ct for ct in clinical_trials if ct['IDA'] == p['mrn']]
+        if self.abort:
+            return
 
-            # If there are any clinical trials then flag for this patient
-            if len(patient_clinical_trials) > 0:
-                p['clinical_trial'] = True
-                p['name'] = patient_clinical_trials[0]['Last_Name'] + ' ' + patient_clinical_trials[0]['First_Name'] + ' ' + patient_clinical_trials[0]['MIddle_Name']
+        # If the OIS results are missing, then OIS probably isn't configured
+        if self.ois_index is None:
+            self.queue.put({'error' : 'Could not query OIS', 'msg' : 'OIS could not be queried. Check connection settings.' })
+            return
 
-            # Get the 4D entries for this patient
-            patient_has_4d = [h4 for h4 in has_4d if h4['IDA'] == p['mrn']]
+        index = self.ois_index
 
-            # If there are any 4D entires then flag for this patient
-            if len(patient_has_4d) > 0:
-                p['has_4d'] = True
-                p['name'] = patient_has_4d[0]['Last_Name'] + ' ' + patient_has_4d[0]['First_Name'] + ' ' + patient_has_4d[0]['MIddle_Name']
+        for p in self.directories:
 
-            # Set the action for this patient directory based on the flags just set
-            if p['finished_treatment']:
+            if self.abort:
+                break
 
-                if p['clinical_trial'] or p['has_4d']:
-                    p['action'] = 'ARCHIVE'
-                else:
-                    p['action'] = 'DELETE'
+            if p['action'] == 'IGNORE':
+                continue
 
+            classify_patient(p, index.get(p['mrn'], {}))
 
         logger.debug('Patient Directories: ' + str(self.directories))
 
+        # Remember how each patient was classified for the next scan
+        if self.ois_cache and not self.abort:
+
+            actions = dict([(p['mrn'], p['action']) for p in self.directories if not p['action'] == 'IGNORE'])
+
+            changed = [mrn for mrn, action in actions.items()
+                if mrn in self.ois_entries and self.ois_entries[mrn]['action'] and not self.ois_entries[mrn]['action'] == action]
+            logger.info('%d patients classified differently to the last scan', len(changed))
+
+            update_ois_cache(lambda cache: cache.record_actions(actions))
+
 
 class PerformActionTask(threading.Thread):
 
@@ -353,110 +1033,288 @@ class PerformActionTask(threading.Thread):
         
         # Just double check that these patients are really for this action
         dirs = [d for d in self.patients if d['action'] == self.action]
+
+        # The scan may have used cached OIS results, so check OIS again before acting
+        if len(dirs) > 0:
+            dirs = self.confirm_actions(dirs, datastore)
         
         # Before performing action, backup any XVI SQL files (if there are patients being actioned)
         if len(dirs) > 0:
             backup_xvi_sql()
 
+        # The catalog may hold a manifest of the files in each directory from the scan
+        catalog = None
+        if datastore['scan_catalog']:
+            try:
+                catalog = ScanCatalog()
+            except Exception:
+                logger.exception('Unable to open scan catalog')
+
+        # Directories with the same name (from different XVI locations) are archived to the
+        # same destination, so these are actioned one after another by the same worker
+        groups = []
+        group_index = {}
+        for d in dirs:
+            if not d['dir_name'] in group_index:
+                group_index[d['dir_name']] = len(groups)
+                groups.append([])
+            groups[group_index[d['dir_name']]].append(d)
+
+        def action_group(group):
+            results = []
+            for d in group:
+                if self.abort:
+                    break
+                results.append(self.action_directory(d, datastore, catalog, dry_run))
+            return results
+
+        # Several patients are actioned at once, each by one of the workers. Messages are
+        # sent to the queue as each patient is actioned, and once stop is called no more
+        # patients are started.
         actioned_dirs = []
 
+        for i, results in thread_imap(action_group, groups, datastore['archive_workers'], lambda: self.abort):
+
+            for d, actioned in zip(groups[i], results):
+
+                if actioned:
+
+                    # Directory successfully actioned
+                    actioned_dirs.append(d)
+
+                    self.record_actioned(d)
+
+        if catalog:
+            catalog.close()
+
+        # Place the actioned directories into the queue as a final step
+        self.queue.put(actioned_dirs)
+
+    # Return the patient directories which are still classified for this action using
+    # their current OIS results, rather than those the scan classified them with (which
+    # may have been cached, see ois_check_reason). No directories are returned if OIS
+    # can't be queried.
+    def confirm_actions(self, dirs, datastore):
+
+        mrns = sorted(set([d['mrn'] for d in dirs]))
+        index = query_ois_index(mrns)
+
+        if index is None:
+            logger.error('Unable to query OIS to confirm the patients to %s', self.action)
+            self.queue.put('Error: Could not query OIS to confirm the patients, no patients actioned')
+            return []
+
+        if datastore['ois_cache']:
+            update_ois_cache(lambda cache: cache.update(dict([(mrn, index.get(mrn, {})) for mrn in mrns])))
+
+        confirmed = []
         for d in dirs:
 
-            if self.abort:
-                break
+            p = dict(d, action='KEEP', finished_treatment=False, clinical_trial=False, has_4d=False, last_fraction_date="")
+            classify_patient(p, index.get(d['mrn'], {}))
 
-            src = os.path.join(d["path"],d["dir_name"])
+            if p['action'] == self.action:
+                confirmed.append(d)
+            else:
+                logger.warning('%s is now classified as %s in OIS, not actioned', d['mrn'], p['action'])
+                self.queue.put(d["mrn"] + " - " + d['name'] + ": Not actioned, OIS now shows " + p['action'])
 
-            # If archive action, first copy the directory
+        return confirmed
 
-            if self.action == "ARCHIVE":
+    # Archive or delete a patient directory, sending messages about its progress to the
+    # queue. Returns True if the directory was actioned successfully. An archived directory
+    # is only deleted once it has been copied and verified.
+    def action_directory(self, d, datastore, catalog, dry_run):
 
-                dst = os.path.join(datastore['archive_path'],d["dir_name"])
+        src = os.path.join(d["path"],d["dir_name"])
 
-                # Copy the directory recursively to the destination. If the destination directory already exists,
-                # or another exception occurs, alert the user and skip this directory
-                try:
-                    if not dry_run:
-                        shutil.copytree(src, dst)
+        # If archive action, first copy the directory
+
+        if self.action == "ARCHIVE":
+
+            dst = os.path.join(datastore['archive_path'],d["dir_name"])
+
+            # If a manifest was recorded during the scan and the directory hasn't changed since,
+            # the files can be copied and verified without walking the directory again
+            manifest = None
+            if catalog:
+                manifest = catalog.get_manifest(d["path"], d["dir_name"])
+                if manifest and not directory_unchanged(src, manifest['dir_mtimes']):
+                    logger.info('%s has changed since it was scanned, manifest not used', src)
+                    manifest = None
+
+            # Checksums of each file are computed as it is copied, if enabled
+            hash_name = datastore['archive_checksum']
+            checksums = None
+            dir_mtimes = manifest['dir_mtimes'] if manifest else None
+
+            # The files copied are recorded in a journal next to the destination directory, so that
+            # an interrupted copy is resumed the next time the directory is archived
+            journal = None
+
+            # Copy the directory recursively to the destination. If the destination directory already exists
+            # (without a journal), or another exception occurs, alert the user and skip this directory
+            try:
+                if dry_run:
+                    time.sleep(2)
+                else:
+                    journal = CopyJournal(dst + '.journal', src)
+
+                    if manifest:
+                        checksums = copy_from_manifest(src, dst, manifest, datastore['copy_workers'], hash_name, journal)
                     else:
-                        time.sleep(2)
+                        checksums, dir_mtimes = copy_tree(src, dst, datastore['copy_workers'], hash_name, journal)
 
-                    logger.info('%s copied to %s', src, dst)
+                logger.info('%s copied to %s', src, dst)
+            except Exception as e:
+                logging.exception("Exception while copying %s to %s", src, dst)
+                error_msg = "The following error occurred while copying from\n" + src + "\nto\n" + dst + "\n\n" + str(e) + "\n\nThe patient directory has not be deleted."
+                logger.error(error_msg)
+                self.queue.put(d["mrn"] + " - " + d['name'] + ": Error copying to " + dst + " - " + str(e))
+                return False
+            finally:
+                if journal:
+                    journal.close()
+
+            if checksums is not None:
+
+                # Read back each file copied to check its checksum, and check that nothing was added
+                # to or removed from the src directory while copying
+                failed_files, copied_size = verify_checksums(dst, checksums, hash_name, datastore['copy_workers'])
+                problems = [failed_files[f] for f in sorted(failed_files)]
+                if not directory_unchanged(src, dir_mtimes):
+                    problems.append(src + ' changed while copying')
+
+                # Walk src again, independently of the listing the files were copied from, to check
+                # that every file in it was copied before it is deleted
+                src_info = get_size_info(src, True, True)
+                if not src_info['complete']:
+                    problems.append(src + ' could not be fully listed')
+                else:
+                    src_files = set([f[0] for f in src_info['manifest']])
+                    problems.extend([f + ' was not copied' for f in sorted(src_files.difference(checksums))])
+
+                    if not (src_info['file_count'] == len(checksums) and src_info['size'] == copied_size):
+                        problems.append('%s has %d files (%d bytes) but %d files (%d bytes) were copied' % (src,
+                            src_info['file_count'], src_info['size'], len(checksums), copied_size))
+
+                if len(problems) > 0:
+                    # The files which don't match are copied again when the directory is next archived
+                    journal.forget(failed_files)
+
+                    logger.error("Copy from %s to %s failed %s verification: %s", src, dst, hash_name, ', '.join(problems[:10]))
+                    error_msg = "The following error occurred while copying from\n" + src + "\nto\n" + dst + "\n\n Copied files do not match the Src directory. \n\nThe patient directory has not be deleted."
+                    logger.error(error_msg)
+                    self.queue.put(d["mrn"] + " - " + d['name'] + ": Error: Dst directory does not match Src.")
+                    return False
+
+                logger.info('%s matches %s checksums of %s (%d files)', dst, hash_name, src, len(checksums))
+
+                # Save the checksums alongside the archived directory
+                checksums_file = os.path.join(datastore['archive_path'], d["dir_name"] + '.' + hash_name)
+                try:
+                    write_checksums(checksums_file, checksums)
                 except Exception as e:
-                    logging.exception("Exception while copying %s to %s", src, dst)
-                    error_msg = "The following error occurred while copying from\n" + src + "\nto\n" + dst + "\n\n" + str(e) + "\n\nThe patient directory has not be deleted."
+                    logging.exception("Exception while writing %s", checksums_file)
+                    self.queue.put(d["mrn"] + " - " + d['name'] + ": Error writing " + checksums_file + " - " + str(e))
+                    return False
+
+            elif manifest and not dry_run:
+
+                # Check every file in the manifest was copied, and that nothing was added to the src
+                # directory while copying
+                problems = verify_against_manifest(dst, manifest)
+                if not directory_unchanged(src, manifest['dir_mtimes']):
+                    problems.append(src + ' changed while copying')
+
+                if len(problems) > 0:
+                    logger.error("Copy from %s to %s does not match manifest: %s", src, dst, ', '.join(problems[:10]))
+                    error_msg = "The following error occurred while copying from\n" + src + "\nto\n" + dst + "\n\n Copied files do not match the files scanned. \n\nThe patient directory has not be deleted."
                     logger.error(error_msg)
-                    self.queue.put(d["mrn"] + " - " + d['name'] + ": Error copying to " + dst + " - " + str(e))
-                    continue
+                    self.queue.put(d["mrn"] + " - " + d['name'] + ": Error: Dst directory does not match Src manifest.")
+                    return False
+
+                logger.info('%s matches manifest of %s (%d files)', dst, src, len(manifest['files']))
+
+            elif not dry_run:
 
                 # Compute the size of the src and dst directories and ensure they are equal
-                src_size = get_size(src)
-                dst_size = get_size(dst)
+                src_info = get_size_info(src, follow_links=True)
+                dst_info = get_size_info(dst, follow_links=True)
+                src_size = src_info['size']
+                dst_size = dst_info['size']
 
-                logger.info('Src (%s) size is %s', src, src_size)
-                logger.info('Dst (%s) size is %s', dst, dst_size)
+                logger.info('Src (%s) size is %s (%d files)', src, src_size, src_info['file_count'])
+                logger.info('Dst (%s) size is %s (%d files)', dst, dst_size, dst_info['file_count'])
 
-                if not src_size == dst_size and not dry_run:
-                    logger.error("Directory sizes do not match after copy from %s to %s", src, dst)
+                if not (src_info['complete'] and dst_info['complete'] and src_size == dst_size and src_info['file_count'] == dst_info['file_count']):
+                    logger.error("Directory sizes or file counts do not match after copy from %s to %s", src, dst)
                     error_msg = "The following error occurred while copying from\n" + src + "\nto\n" + dst + "\n\n Directory sizes do not match after copy. \n\nThe patient directory has not be deleted."
                     logger.error(error_msg)
                     self.queue.put(d["mrn"] + " - " + d['name'] + ": Error: Src and Dst directory sizes do not match.")
-                    continue
+                    return False
 
                 logger.info('%s same size as %s', src, dst)
 
+            # The copy is complete, so the journal is no longer needed
+            if journal:
+                try:
+                    journal.remove()
+                except OSError:
+                    logging.exception("Exception while removing %s", journal.journal_file)
 
-            # Now delete the src directory
-            try:
-                if not dry_run:
-                    shutil.rmtree(src)
-                else:
-                    time.sleep(2)
+        # Now delete the src directory
+        try:
+            if not dry_run:
+                shutil.rmtree(src)
+            else:
+                time.sleep(2)
 
-            except Exception as e:
-                logging.exception("Exception while deleting %s", src)
-                error_msg = "The following error occurred while deleting\n" + src + "\n\n" + str(e) + "\n\nThe patient directory has potentially been partially deleted, however the copy to the archive location was successful."
-                logger.error(error_msg)
-                self.queue.put(d["mrn"] + " - " + d['name'] + ": Error deleting " + str(e))
-                continue
+        except Exception as e:
+            logging.exception("Exception while deleting %s", src)
+            error_msg = "The following error occurred while deleting\n" + src + "\n\n" + str(e) + "\n\nThe patient directory has potentially been partially deleted, however the copy to the archive location was successful."
+            logger.error(error_msg)
+            self.queue.put(d["mrn"] + " - " + d['name'] + ": Error deleting " + str(e))
+            return False
 
-            logger.info('%s has been deleted', src)
+        logger.info('%s has been deleted', src)
 
-            if self.action == "ARCHIVE":
-                self.queue.put(d["mrn"] + " - " + d['name'] + ": Successfully Archived to " + dst)
-            elif self.action == "DELETE":
-                self.queue.put(d["mrn"] + " - " + d['name'] + ": Successfully Deleted")
+        if catalog:
+            catalog.remove(d["path"], d["dir_name"])
 
-            # Directory successfully actioned
-            actioned_dirs.append(d)
+        if self.action == "ARCHIVE":
+            self.queue.put(d["mrn"] + " - " + d['name'] + ": Successfully Archived to " + dst)
+        elif self.action == "DELETE":
+            self.queue.put(d["mrn"] + " - " + d['name'] + ": Successfully Deleted")
 
-            # Update actioned.yaml with directory
-            date = datetime.now().strftime("%Y-%m-%d")
-            archived = []
-            deleted = []
+        return True
 
-            try:
-                with open('actioned.yaml', 'r') as f:
+    # Add a patient directory which has been actioned to actioned.yaml
+    def record_actioned(self, d):
 
-                    previous = yaml.load(f)
+        date = datetime.now().strftime("%Y-%m-%d")
+        archived = []
+        deleted = []
 
-                    if previous['ARCHIVED']:
-                        archived = previous['ARCHIVED']
+        try:
+            with open('actioned.yaml', 'r') as f:
 
-                    if previous['DELETED']:
-                        deleted = previous['DELETED']
-            except:
-                # No previous patients actioned
-                pass
+                previous = yaml.load(f)
 
-            if d['action'] == 'ARCHIVE':
-                archived.append(d['mrn'] + " on " + date)
-            elif d['action'] == 'DELETE':
-                deleted.append(d['mrn'] + " on " + date)
+                if previous['ARCHIVED']:
+                    archived = previous['ARCHIVED']
 
-            actioned = { 'ARCHIVED': archived, 'DELETED' : deleted }
-            with open('actioned.yaml', 'w') as f:
-                yaml.dump(actioned, f, default_flow_style=False)
+                if previous['DELETED']:
+                    deleted = previous['DELETED']
+        except:
+            # No previous patients actioned
+            pass
 
-        # Place the actioned directories into the queue as a final step
-        self.queue.put(actioned_dirs)
+        if d['action'] == 'ARCHIVE':
+            archived.append(d['mrn'] + " on " + date)
+        elif d['action'] == 'DELETE':
+            deleted.append(d['mrn'] + " on " + date)
+
+        actioned = { 'ARCHIVED': archived, 'DELETED' : deleted }
+        with open('actioned.yaml', 'w') as f:
+            yaml.dump(actioned, f, default_flow_style=False)
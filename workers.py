@@ -0,0 +1,87 @@
+# Copyright 2022 University of New South Wales, Ingham Institute
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading, Queue
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Run func on each of the items using a bounded pool of worker threads, yielding an
+# (index, result) tuple for each item as soon as it has been processed. If abort is
+# given it is called before each item is started, once it returns True the remaining
+# items are skipped. If func raises an exception for any item, it is logged and the
+# first exception is raised again once all the workers have finished.
+def thread_imap(func, items, num_workers, abort=None):
+
+    items = list(items)
+    errors = []
+
+    todo = Queue.Queue()
+    for i, item in enumerate(items):
+        todo.put((i, item))
+
+    done = Queue.Queue()
+
+    def worker():
+        try:
+            while True:
+                try:
+                    i, item = todo.get(False)
+                except Queue.Empty:
+                    return
+
+                if abort and abort():
+                    return
+
+                try:
+                    done.put((i, func(item)))
+                except Exception as e:
+                    logger.exception('Exception in worker thread')
+                    errors.append(e)
+        finally:
+            # Let the caller know this worker has finished
+            done.put(None)
+
+    num_workers = max(1, min(int(num_workers), len(items)))
+
+    threads = [threading.Thread(target=worker) for w in range(num_workers)]
+    for t in threads:
+        t.start()
+
+    running = num_workers
+    while running > 0:
+        result = done.get()
+        if result is None:
+            running -= 1
+        else:
+            yield result
+
+    for t in threads:
+        t.join()
+
+    if errors:
+        raise errors[0]
+
+# Run func on each of the items using a bounded pool of worker threads and return
+# the results in the same order as the items. Items skipped because of abort are
+# left as None, see thread_imap.
+def thread_map(func, items, num_workers, abort=None):
+
+    items = list(items)
+    results = [None] * len(items)
+
+    for i, result in thread_imap(func, items, num_workers, abort):
+        results[i] = result
+
+    return results